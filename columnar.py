@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+  The `columnar` module.
+
+  Compact columnar snapshot of the `bug_tasks` table of the mirror
+  (`<project>.col`) for fast analytics without sqlite.
+
+  Bug ids are stored as a typed integer array, string columns are
+  dictionary-encoded: every distinct value is stored once in the header and
+  rows keep its index in the smallest integer array fitting the dictionary.
+  Arrays are aligned in the file, so it is memory-mapped and a column is
+  copied out of the map only when it is used first: opening a snapshot
+  reads its header, a filter reads the pages of its own columns only and
+  is evaluated over integer codes.
+
+  Layout:
+    8 bytes   magic
+    4 bytes   header length, little-endian
+    header    JSON: rows count, dictionaries, offsets and typecodes of columns
+    columns   little-endian arrays, 8 bytes aligned
+
+  Usage:
+    $ columnar.py fuel mos
+"""
+
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+from array import array
+
+import mirror
+
+MAGIC = 'LPBTCOL1'
+ALIGNMENT = 8
+
+ENCODED_COLUMNS = ('target', 'milestone', 'status', 'importance', 'assignee')
+COLUMNS = ('bug_id',) + ENCODED_COLUMNS
+
+
+def snapshot_path(project_name):
+    """Path of the columnar snapshot of the project mirror."""
+    return '%s.col' % project_name
+
+
+def _code_typecode(size):
+    for typecode in ('b', 'h', 'i'):
+        if size <= 2 ** (array(typecode).itemsize * 8 - 1):
+            return typecode
+    raise ValueError('Dictionary is too large: %s values' % size)
+
+
+def _to_bytes(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def export(db_file, path):
+    """Write the `bug_tasks` table of the mirror into the snapshot file."""
+    conn = sqlite3.connect(db_file)
+    try:
+        rows = conn.execute('SELECT %s FROM bug_tasks ORDER BY bug_id, target' % ', '.join(COLUMNS)).fetchall()
+    finally:
+        conn.close()
+
+    dictionaries = {}
+    columns = {'bug_id': array('i', (row[0] for row in rows))}
+    for position, name in enumerate(ENCODED_COLUMNS, 1):
+        values = sorted(set(row[position] for row in rows))
+        codes = dict((value, code) for code, value in enumerate(values))
+        dictionaries[name] = values
+        columns[name] = array(_code_typecode(len(values)), (codes[row[position]] for row in rows))
+
+    header = {'rows': len(rows), 'dictionaries': dictionaries, 'columns': {}}
+    # offsets depend on the header length, so they are computed for the final header size
+    while True:
+        encoded = json.dumps(header, sort_keys=True)
+        offset = len(MAGIC) + 4 + len(encoded)
+        layout = {}
+        for name in COLUMNS:
+            offset += -offset % ALIGNMENT
+            layout[name] = {
+                'offset': offset,
+                'typecode': columns[name].typecode,
+                'itemsize': columns[name].itemsize,
+            }
+            offset += len(columns[name]) * columns[name].itemsize
+        if layout == header['columns']:
+            break
+        header['columns'] = layout
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as snapshot:
+        snapshot.write(MAGIC)
+        snapshot.write(struct.pack('<I', len(encoded)))
+        snapshot.write(encoded)
+        for name in COLUMNS:
+            snapshot.write('\0' * (layout[name]['offset'] - snapshot.tell()))
+            snapshot.write(_to_bytes(columns[name]))
+    os.rename(tmp_path, path)
+    return len(rows)
+
+
+def export_project(project_name):
+    """Export the mirror of the project into its snapshot file."""
+    return export(mirror.db_path(project_name), snapshot_path(project_name))
+
+
+class Snapshot(object):
+    """Memory-mapped columnar snapshot of the bug tasks mirror.
+
+    `columns` are loaded from the map on first access.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot:
+            self._mmap = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s isn't a bug tasks snapshot" % path)
+        header_start = len(MAGIC) + 4
+        header_length = struct.unpack('<I', self._mmap[len(MAGIC):header_start])[0]
+        header = json.loads(self._mmap[header_start:header_start + header_length])
+
+        self.rows = header['rows']
+        self.dictionaries = header['dictionaries']
+        self.layout = header['columns']
+        for column in self.layout.values():
+            if array(str(column['typecode'])).itemsize != column['itemsize']:
+                raise ValueError('Snapshot %s was written on an incompatible platform' % path)
+        self.columns = _Columns(self)
+
+    def load_column(self, name):
+        """Copy the column out of the map."""
+        column = self.layout[name]
+        values = array(str(column['typecode']))
+        values.fromstring(self._mmap[column['offset']:column['offset'] + self.rows * values.itemsize])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values
+
+    def __len__(self):
+        return self.rows
+
+    def close(self):
+        self._mmap.close()
+
+    def codes(self, name, values):
+        """Return codes of the `values` of the encoded column, unknown values are ignored."""
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        dictionary = self.dictionaries[name]
+        return set(dictionary.index(value) for value in values if value in dictionary)
+
+    def select(self, **bug_task_filter):
+        """Return indexes of rows matching the filter.
+
+        Values of the filter are either a single value or a list of allowed
+        values, like filters of `work.BTSearch`.
+        """
+        matching = None
+        for name, values in bug_task_filter.items():
+            column = self.columns[name]
+            if name == 'bug_id':
+                allowed = set(values if isinstance(values, (list, tuple, set)) else [values])
+            else:
+                allowed = self.codes(name, values)
+            if matching is None:
+                matching = [index for index, code in enumerate(column) if code in allowed]
+            else:
+                matching = [index for index in matching if column[index] in allowed]
+            if not matching:
+                break
+        return range(self.rows) if matching is None else matching
+
+    def row(self, index):
+        """Return the decoded row."""
+        row = {'bug_id': self.columns['bug_id'][index]}
+        for name in ENCODED_COLUMNS:
+            row[name] = self.dictionaries[name][self.columns[name][index]]
+        return row
+
+    def bug_ids(self, indexes):
+        """Return sorted distinct bug ids of the rows."""
+        bug_id = self.columns['bug_id']
+        return sorted(set(bug_id[index] for index in indexes))
+
+
+class _Columns(dict):
+    """Columns of the snapshot, loaded on first access."""
+
+    def __init__(self, snapshot):
+        super(_Columns, self).__init__()
+        self.snapshot = snapshot
+
+    def __missing__(self, name):
+        self[name] = self.snapshot.load_column(name)
+        return self[name]
+
+
+def main():
+    for project_name in sys.argv[1:]:
+        rows = export_project(project_name)
+        sys.stdout.write("%s: %s bug tasks exported to %s\n" % (project_name, rows, snapshot_path(project_name)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+  The `connection_pool` module.
+
+  Pool of Launchpad clients shared by worker threads. Every client owns
+  its persistent keep-alive connection (launchpadlib connections can't be
+  used by two threads at once), so a pool of N clients is a pool of N
+  connections: clients are created on demand up to N, checked out for one
+  operation and handed to the next thread, which skips the login and the
+  TLS handshake.
+
+  Utilization counters show whether the pool is the bottleneck: threads
+  waiting for a client long and utilization close to 1 ask for more
+  connections.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_SIZE = 8
+
+
+class ClientPool(object):
+    """Thread-safe pool of up to `size` clients made by `factory`."""
+
+    def __init__(self, factory, size=DEFAULT_SIZE):
+        self.factory = factory
+        self.size = max(1, size)
+        self.lock = threading.Condition()
+        self.idle = []
+        self.created = 0
+        self.in_use = 0
+
+        self.started = time.time()
+        self.acquisitions = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.busy_seconds = 0.0
+        self.max_in_use = 0
+        self._checked_out = {}
+
+    def add(self, client):
+        """Put an already authenticated client into the pool."""
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                self.idle.append(client)
+                self.lock.notify()
+
+    def acquire(self):
+        """Take an idle client, create one or wait for a client to be released."""
+        started = time.time()
+        with self.lock:
+            waited = False
+            while not self.idle and self.created >= self.size:
+                waited = True
+                self.lock.wait()
+            self.acquisitions += 1
+            if waited:
+                self.waits += 1
+                self.wait_seconds += time.time() - started
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            if self.idle:
+                client = self.idle.pop()
+                self._checked_out[id(client)] = time.time()
+                return client
+            self.created += 1
+
+        try:
+            client = self.factory()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+                self.in_use -= 1
+                self.lock.notify()
+            raise
+        with self.lock:
+            self._checked_out[id(client)] = time.time()
+        return client
+
+    def release(self, client):
+        """Return the client checked out by `acquire`."""
+        with self.lock:
+            self.busy_seconds += time.time() - self._checked_out.pop(id(client))
+            self.in_use -= 1
+            self.idle.append(client)
+            self.lock.notify()
+
+    @contextmanager
+    def client(self):
+        """Check out a client for the block."""
+        client = self.acquire()
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def stats(self):
+        """Return utilization counters of the pool."""
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            return {
+                'size': self.size,
+                'created': self.created,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'acquisitions': self.acquisitions,
+                'waits': self.waits,
+                'wait_seconds': self.wait_seconds,
+                'utilization': self.busy_seconds / (self.size * elapsed),
+            }
+
+    def report(self):
+        """Return human readable utilization counters."""
+        stats = self.stats()
+        stats['utilization'] *= 100
+        return ('%(created)s/%(size)s connections, %(acquisitions)s checkouts, at most %(max_in_use)s in use, '
+                '%(waits)s waits (%(wait_seconds).1f seconds), utilization %(utilization).0f%%' % stats)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+  The `http_cache` module.
+
+  URL keyed cache of Launchpad JSON responses revalidated with ETags.
+
+  A cached response is requested with `If-None-Match`, so unchanged
+  resources cost a bodyless `304 Not Modified` instead of a full download.
+  Hit and miss counters are kept to show how much revalidation saved.
+"""
+
+import sqlite3
+import threading
+import time
+
+from lazr.restfulclient.errors import error_for
+
+
+def cache_path(project_name):
+    """Path of the response cache shared by the tools working on the project."""
+    return '%s.cache.db' % project_name
+
+
+class ResponseCache(object):
+    """Response cache safe to share between threads.
+
+    Requests are sent through the connection of the Launchpad client passed
+    to `get`, so each thread may keep using its own client.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, etag TEXT, body BLOB)')
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.seconds_saved = 0.0
+        self._miss_seconds = 0.0
+
+    def get(self, lp, url):
+        """Return the body of `url`, reusing the cached one if it is not modified."""
+        with self.lock:
+            cached = self.conn.execute('SELECT etag, body FROM responses WHERE url = ?', (url,)).fetchone()
+
+        headers = {'Accept': 'application/json'}
+        if cached:
+            headers['If-None-Match'] = cached[0]
+
+        started = time.time()
+        response, content = lp._browser._connection.request(url, headers=headers)
+        elapsed = time.time() - started
+
+        if response.status == 304 and cached:
+            self._hit(str(cached[1]), elapsed)
+            return str(cached[1])
+
+        error = error_for(response, content)
+        if error:
+            raise error
+
+        if getattr(response, 'fromcache', False):
+            # revalidated by the httplib2 cache of launchpadlib
+            self._hit(content, elapsed)
+        else:
+            self._miss(content, elapsed)
+
+        if response.get('etag'):
+            with self.lock:
+                self.conn.execute('INSERT OR REPLACE INTO responses (url, etag, body) VALUES (?, ?, ?)',
+                                  (url, response['etag'], sqlite3.Binary(content)))
+                self.conn.commit()
+        return content
+
+    def _hit(self, content, elapsed):
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += len(content)
+            if self.misses:
+                self.seconds_saved += max(0.0, self._miss_seconds / self.misses - elapsed)
+
+    def _miss(self, content, elapsed):
+        with self.lock:
+            self.misses += 1
+            self._miss_seconds += elapsed
+
+    def stats(self):
+        """Return counters of the cache."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_saved': self.bytes_saved,
+            'seconds_saved': self.seconds_saved,
+        }
+
+    def report(self):
+        """Return human readable counters of the cache."""
+        return '%(hits)s hits, %(misses)s misses, %(bytes_saved)s bytes and %(seconds_saved).1f seconds saved' % (
+            self.stats())
@@ -1,69 +1,362 @@
-import dataset
+#!/usr/bin/env python
+"""
+  The `import_all` script.
+
+  Mirrors bug tasks of Launchpad projects into local sqlite databases
+  (`<project>.db`) which are used by `work.py` to select bugs to process.
+
+  Search results are streamed page by page into a bounded queue, bug tasks
+  are fetched by a pool of workers, each of them owns its own Launchpad
+  client as httplib2 connections can't be shared between threads.
+  All database writes are done by the main thread only, they are buffered
+  and committed in large transactions by `mirror.MirrorWriter`.
+
+  In incremental mode only bugs changed since the previous successful run
+  are fetched, the per-project watermark is kept in the `sync_state` table
+  of the mirror. Bugs which dropped out of the search results are removed
+  by the reconciliation pass, it lists bug ids only and is much cheaper
+  than a full import.
+
+  Collection mode skips per-bug requests completely: bug tasks are read
+  from large `searchTasks` pages of the project and each of its series, so
+  a full refresh costs about N/300 requests instead of N+1. Tasks of other
+  projects which share the bug are not mirrored in this mode.
+
+  Usage:
+    $ import_all.py -w 16 fuel mos
+
+    # nightly sync
+    $ import_all.py --incremental --reconcile fuel mos
+
+    # full refresh from collection pages
+    $ import_all.py --collections fuel mos
+
+    # refresh and export the columnar snapshot for analytics
+    $ import_all.py --incremental --export fuel mos
+
+    # one project at a time
+    $ import_all.py -j 1 fuel mos
+"""
+
+import argparse
 import json
+import multiprocessing
 import sys
+import threading
+import urllib
+import Queue
+from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+
 from launchpadlib.launchpad import Launchpad
 
-lp = Launchpad.login_with(
-    application_name='lp_release_migrator',
-    service_root='production',
-    credentials_file='lp_release_migrator/lp_release_migrator_credentials.conf',
-    version='devel'
-)
+import columnar
+import http_cache
+import mirror
+import pipeline
+from mirror import URI
+
+STATUSES = [
+    "New",
+    "Incomplete",
+    "Opinion",
+    "Invalid",
+    "Won't Fix",
+    "Expired",
+    "Confirmed",
+    "Triaged",
+    "In Progress",
+    "Fix Committed",
+    "Fix Released",
+]
+
+DEFAULT_PROJECTS = ['mos', 'fuel']
+DEFAULT_WORKERS = 8
+PAGE_SIZE = 300  # the largest page Launchpad serves
+
+_local = threading.local()
+
+
+def login():
+    return Launchpad.login_with(
+        application_name='lp_release_migrator',
+        service_root='production',
+        credentials_file='lp_release_migrator/lp_release_migrator_credentials.conf',
+        version='devel'
+    )
+
+
+def thread_lp():
+    """Launchpad client owned by the current thread."""
+    if not hasattr(_local, 'lp'):
+        _local.lp = login()
+    return _local.lp
+
+
+def fetch_bug_tasks(cache, bug_id):
+    res = json.loads(cache.get(thread_lp(), '%s/bugs/%s/bug_tasks' % (URI, bug_id)))
+    return bug_id, res['entries']
+
+
+class Progress(object):
+    """Single line progress of the projects being imported."""
+
+    def __init__(self):
+        self.state = OrderedDict()
+
+    def update(self, project_name, done, total=None):
+        self.state[project_name] = '%s / %s' % (done, total) if total is not None else '%s tasks' % done
+        sys.stdout.write('\r' + ' | '.join('%s: %s' % item for item in self.state.items()))
+        sys.stdout.flush()
+
+    def message(self, text):
+        sys.stdout.write('\n%s\n' % text)
+        sys.stdout.flush()
+
+
+class QueueProgress(object):
+    """Progress of a child process, reported to the parent through a queue."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def update(self, project_name, done, total=None):
+        self.queue.put(('update', (project_name, done, total)))
+
+    def message(self, text):
+        self.queue.put(('message', (text,)))
+
+
+def bug_id_from_link(project_name, self_link):
+    return int(mirror.cut_prefix(self_link, '%s/%s/+bug/' % (URI, project_name)))
+
+
+def bug_id_from_bug_link(bug_link):
+    return int(bug_link.rsplit('/', 1)[1])
+
+
+def iter_pages(lp, url):
+    """Yield entries of every page of the collection with the next page link."""
+    while url:
+        page = json.loads(lp._browser.get(url))
+        url = page.get('next_collection_link')
+        yield page['entries'], url
 
-for project_name in ['mos', 'fuel']:  #, 'mos']:
-    db = dataset.connect('sqlite:///%s.db' % project_name)
+
+def search_tasks_url(target, modified_since=None):
+    params = [
+        ('ws.op', 'searchTasks'),
+        ('ws.size', PAGE_SIZE),
+        # series targeted tasks are imported from the series themselves
+        ('omit_targeted', 'false'),
+    ]
+    params.extend(('status', status) for status in STATUSES)
+    if modified_since:
+        params.append(('modified_since', modified_since))
+    return '%s/%s?%s' % (URI, target, urllib.urlencode(params))
+
+
+def run_mode(name, incremental):
+    return name + ('-incremental' if incremental else '')
+
+
+def import_project_collections(lp, project_name, progress, incremental=False, restart=False):
+    """Import bug tasks from collection pages of the project and its series."""
+    project = lp.projects[project_name]
+    targets = [project_name] + ['%s/%s' % (project_name, series.name) for series in project.series]
+
+    with mirror.MirrorWriter(mirror.db_path(project_name)) as writer:
+        started, resumed = writer.begin_run(
+            project_name, run_mode('collections', incremental), datetime.utcnow().isoformat(), restart
+        )
+        watermark = writer.get_watermark(project_name) if incremental else None
+        pages = writer.journaled_pages() if resumed else {}
+        if resumed:
+            progress.message("%s: resuming import started at %s" % (project_name, started))
+
+        counter = 0
+        for target in targets:
+            url = pages.get(target, search_tasks_url(target, watermark))
+            for entries, next_link in iter_pages(lp, url):
+                counter += len(entries)
+                progress.update(project_name, counter)
+                rows = [mirror.entry_to_row(project_name, bug_id_from_bug_link(entry['bug_link']), entry)
+                        for entry in entries]
+                writer.write_rows(rows, target, next_link)
+
+        if not watermark:
+            pruned = writer.prune(project_name)
+            progress.message("%s: %s stale bug tasks removed" % (project_name, pruned))
+        writer.finish_run(project_name, started)
+
+
+def reconcile_project(lp, project_name, progress):
+    """Remove bugs which are not returned by the project search anymore."""
+    tasks = lp.projects[project_name].searchTasks(status=STATUSES)
+    ids = set(bug_id_from_link(project_name, bt.self_link) for bt in tasks)
+
+    with mirror.MirrorWriter(mirror.db_path(project_name)) as writer:
+        dropped = writer.reconcile(ids)
+    progress.message("%s: %s bugs dropped out of the search results" % (project_name, dropped))
+
+
+def import_project(lp, project_name, progress, workers=DEFAULT_WORKERS, incremental=False, restart=False):
     project = lp.projects[project_name]
-    tasks = project.searchTasks(status=[
-        "New",
-        "Incomplete",
-        "Opinion",
-        "Invalid",
-        "Won't Fix",
-        "Expired",
-        "Confirmed",
-        "Triaged",
-        "In Progress",
-        "Fix Committed",
-        "Fix Released",
-    ])
-
-    bugs = db['bugs']
-    bug_tasks = db['bug_tasks']
-
-    bug_tasks.create_index([
-        'project',
-        'bug_id',
-        'target',
-        'milestone',
-        'status',
-        'importance',
-        'assignee',
-    ])
-
-    counter = 0
-    ids = [int(bt.self_link.lstrip('https://api.launchpad.net/devel/%s/+bug/' % project_name)) for bt in tasks]
-    for bug_id in ids:
-        counter += 1
-        sys.stdout.write("%s / %s\r" % (counter, len(ids)))
-        res = json.loads(lp._browser.get('https://api.launchpad.net/devel/bugs/%s/bug_tasks' % bug_id))
-        bugs.upsert({'id':bug_id}, ['id'])
-        for entry in res['entries']:
-            data = {
-                'project': project_name,
-                'bug_id':bug_id,
-                'target':entry['target_link'].lstrip('https://api.launchpad.net/devel/') if entry['target_link'] else None,
-                'milestone':entry['milestone_link'].lstrip('https://api.launchpad.net/devel/%s/+milestone/' % project_name) if entry['milestone_link'] else None,
-                'status':entry['status'],
-                'importance':entry['importance'],
-                'assignee':entry['assignee_link'].lstrip('https://api.launchpad.net/devel/') if entry['assignee_link'] else None,
-            }
-            print data
-            try:
-                row = bug_tasks.find_one(bug_id=data['bug_id'], target=data['target'])
-            except:
-                print "ERROR"
-            if row:
-                data['id'] = row['id']
-                bug_tasks.update(data, ['id'])
-            else:
-                bug_tasks.insert(data)
+
+    with mirror.MirrorWriter(mirror.db_path(project_name)) as writer:
+        # changes done while we are importing would be picked up by the next run
+        started, resumed = writer.begin_run(
+            project_name, run_mode('bugs', incremental), datetime.utcnow().isoformat(), restart
+        )
+        done = writer.journaled_bugs() if resumed else set()
+        if resumed:
+            progress.message("%s: resuming import started at %s, %s bugs already imported" % (
+                project_name, started, len(done)))
+
+        watermark = writer.get_watermark(project_name) if incremental else None
+        if watermark:
+            tasks = project.searchTasks(status=STATUSES, modified_since=watermark)
+        else:
+            tasks = project.searchTasks(status=STATUSES)
+
+        total = tasks.total_size
+        ids = (bug_id for bug_id in (bug_id_from_link(project_name, bt.self_link) for bt in tasks)
+               if bug_id not in done)
+
+        cache = http_cache.ResponseCache(http_cache.cache_path(project_name))
+        fetched = pipeline.stream(ids, partial(fetch_bug_tasks, cache), workers)
+        for counter, (bug_id, entries) in enumerate(fetched, len(done) + 1):
+            progress.update(project_name, counter, total)
+            writer.write_bug(bug_id, [mirror.entry_to_row(project_name, bug_id, entry) for entry in entries])
+
+        writer.finish_run(project_name, started)
+        progress.message("%s: bug_tasks cache: %s" % (project_name, cache.report()))
+
+
+def run_import(lp, project_name, arguments, progress):
+    if arguments.collections:
+        import_project_collections(lp, project_name, progress, arguments.incremental, arguments.restart)
+    else:
+        import_project(lp, project_name, progress, arguments.workers, arguments.incremental, arguments.restart)
+    if arguments.reconcile:
+        reconcile_project(lp, project_name, progress)
+    if arguments.export:
+        rows = columnar.export_project(project_name)
+        progress.message("%s: %s bug tasks exported to %s" % (project_name, rows, columnar.snapshot_path(project_name)))
+
+
+def _import_process(project_name, arguments, queue):
+    progress = QueueProgress(queue)
+    try:
+        run_import(thread_lp(), project_name, arguments, progress)
+    except Exception as exc:  # pylint: disable=W0703
+        progress.message("%s: import failed: %r" % (project_name, exc))
+        sys.exit(1)
+
+
+def import_projects(projects, arguments):
+    """Import projects in parallel processes, at most `arguments.jobs` at once.
+
+    Return names of the projects which failed to import.
+    """
+    progress = Progress()
+    queue = multiprocessing.Queue()
+    pending = list(projects)
+    running = {}
+    failed = []
+
+    while pending or running:
+        while pending and len(running) < arguments.jobs:
+            project_name = pending.pop(0)
+            running[project_name] = multiprocessing.Process(
+                target=_import_process, args=(project_name, arguments, queue)
+            )
+            running[project_name].start()
+
+        try:
+            kind, args = queue.get(timeout=1)
+        except Queue.Empty:
+            pass
+        else:
+            getattr(progress, kind)(*args)
+
+        for project_name, process in running.items():
+            if not process.is_alive():
+                process.join()
+                del running[project_name]
+                if process.exitcode:
+                    failed.append(project_name)
+
+    # messages sent right before the last process exited
+    while True:
+        try:
+            kind, args = queue.get(timeout=0.1)
+        except Queue.Empty:
+            break
+        getattr(progress, kind)(*args)
+    sys.stdout.write('\n')
+
+    return failed
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description="Mirror Launchpad bug tasks into <project>.db files"
+    )
+    argument_parser.add_argument(
+        'projects',
+        nargs='*',
+        default=DEFAULT_PROJECTS,
+        help='project names to import (default: %s)' % ', '.join(DEFAULT_PROJECTS)
+    )
+    argument_parser.add_argument(
+        '-w', '--workers',
+        action='store',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help='amount of concurrent bug_tasks fetches (default: %s)' % DEFAULT_WORKERS
+    )
+    argument_parser.add_argument(
+        '-i', '--incremental',
+        action='store_true',
+        help='fetch only bugs changed since the previous successful import'
+    )
+    argument_parser.add_argument(
+        '-C', '--collections',
+        action='store_true',
+        help='build the mirror from collection pages instead of per-bug requests'
+    )
+    argument_parser.add_argument(
+        '-r', '--reconcile',
+        action='store_true',
+        help='remove bugs which are not returned by the project search anymore'
+    )
+    argument_parser.add_argument(
+        '-e', '--export',
+        action='store_true',
+        help='export the mirror into the columnar <project>.col snapshot after import'
+    )
+    argument_parser.add_argument(
+        '--restart',
+        action='store_true',
+        help='discard the journal of an interrupted import instead of resuming it'
+    )
+    argument_parser.add_argument(
+        '-j', '--jobs',
+        action='store',
+        type=int,
+        default=0,
+        help='amount of projects imported concurrently (default: all of them)'
+    )
+    arguments = argument_parser.parse_args()
+    arguments.jobs = arguments.jobs or len(arguments.projects)
+
+    failed = import_projects(arguments.projects, arguments)
+    if failed:
+        sys.stderr.write("Import failed for: %s\n" % ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+  The `lp_async` module.
+
+  asyncio client of the Launchpad REST API, an alternative to launchpadlib
+  for tools which keep hundreds of reads and writes in flight from a single
+  thread.
+
+  Requests are signed with the OAuth credentials saved by launchpadlib
+  (PLAINTEXT signatures, like launchpadlib does) and sent over a small pool
+  of persistent HTTP/1.1 connections. Every call returns an asyncio future
+  of the decoded JSON response, futures are awaited or gathered:
+
+    client = AsyncLaunchpad.from_credentials_file(path)
+    bugs = client.run(client.get(link) for link in bug_links)
+
+  The module needs Python 3 (asyncio) and is meant for Python 3 tools, the
+  launchpadlib based `LpClient` tools keep using threads. It is written
+  without the async syntax so the Python 2 toolchain still compiles it.
+  `test_lp_async.py` runs it against a local fake server.
+"""
+
+import json
+import random
+import ssl
+import time
+
+try:
+    import asyncio
+except ImportError:  # Python 2
+    asyncio = None
+
+try:
+    from configparser import ConfigParser
+    from urllib.parse import quote, urlencode, urlsplit
+except ImportError:  # Python 2
+    from ConfigParser import ConfigParser
+    from urllib import quote, urlencode
+    from urlparse import urlsplit
+
+DEFAULT_CONNECTIONS = 8
+SERVICE_ROOTS = {
+    'production': 'https://api.launchpad.net/',
+    'staging': 'https://api.staging.launchpad.net/',
+}
+
+
+class HTTPError(Exception):
+    """Response with an error status."""
+
+    def __init__(self, method, url, status, body):
+        super(HTTPError, self).__init__('%s %s: HTTP %s %s' % (method, url, status, body[:200]))
+        self.status = status
+        self.body = body
+
+
+class Credentials(object):
+    """OAuth access token of a launchpadlib credentials file."""
+
+    def __init__(self, consumer_key, access_token, access_secret, consumer_secret=''):
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.access_token = access_token
+        self.access_secret = access_secret
+
+    @classmethod
+    def from_file(cls, path):
+        config = ConfigParser()
+        config.read(path)
+        section = config.sections()[0]
+        return cls(
+            config.get(section, 'consumer_key'),
+            config.get(section, 'access_token'),
+            config.get(section, 'access_secret'),
+            config.get(section, 'consumer_secret') if config.has_option(section, 'consumer_secret') else '',
+        )
+
+    def authorization(self):
+        """Return the `Authorization` header value of a request."""
+        params = [
+            ('oauth_consumer_key', self.consumer_key),
+            ('oauth_token', self.access_token),
+            ('oauth_signature_method', 'PLAINTEXT'),
+            ('oauth_signature', '%s&%s' % (quote(self.consumer_secret, safe=''), quote(self.access_secret, safe=''))),
+            ('oauth_timestamp', str(int(time.time()))),
+            ('oauth_nonce', str(random.getrandbits(64))),
+            ('oauth_version', '1.0'),
+        ]
+        return 'OAuth realm="https://api.launchpad.net/", ' + ', '.join(
+            '%s="%s"' % (name, quote(value, safe='')) for name, value in params)
+
+
+def _chain(future, func, loop):
+    """Return a future of `func(result of future)`."""
+    chained = loop.create_future()
+
+    def done(source):
+        if chained.cancelled():
+            return
+        if source.exception() is not None:
+            chained.set_exception(source.exception())
+            return
+        try:
+            chained.set_result(func(source.result()))
+        except Exception as exc:  # pylint: disable=W0703
+            chained.set_exception(exc)
+
+    future.add_done_callback(done)
+    return chained
+
+
+class _Response(object):
+    """Incremental parser of one HTTP/1.1 response."""
+
+    def __init__(self, method):
+        self.method = method
+        self.buffer = b''
+        self.status = None
+        self.headers = {}
+        self.body = b''
+        self.length = None
+        self.chunked = False
+        self.done = False
+
+    def feed(self, data):
+        self.buffer += data
+        if self.status is None:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                return
+            head, self.buffer = self.buffer[:end].decode('latin-1'), self.buffer[end + 4:]
+            lines = head.split('\r\n')
+            self.status = int(lines[0].split(' ', 2)[1])
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                self.headers[name.strip().lower()] = value.strip()
+            self.chunked = 'chunked' in self.headers.get('transfer-encoding', '').lower()
+            if self.method == 'HEAD' or self.status in (204, 304) or 100 <= self.status < 200:
+                self.length = 0
+            elif 'content-length' in self.headers:
+                self.length = int(self.headers['content-length'])
+
+        if self.chunked:
+            self._feed_chunks()
+        elif self.length is not None and len(self.buffer) >= self.length:
+            self.body, self.buffer = self.buffer[:self.length], self.buffer[self.length:]
+            self.done = True
+
+    def _feed_chunks(self):
+        while True:
+            end = self.buffer.find(b'\r\n')
+            if end < 0:
+                return
+            size = int(self.buffer[:end].split(b';')[0], 16)
+            if size == 0:
+                trailer = self.buffer.find(b'\r\n\r\n', end)
+                if trailer < 0:
+                    return
+                self.buffer = self.buffer[trailer + 4:]
+                self.done = True
+                return
+            if len(self.buffer) < end + 2 + size + 2:
+                return
+            self.body += self.buffer[end + 2:end + 2 + size]
+            self.buffer = self.buffer[end + 2 + size + 2:]
+
+    def eof(self):
+        """Finish a response delimited by the end of the connection."""
+        if self.status is not None and self.length is None and not self.chunked:
+            self.body, self.done = self.buffer, True
+        return self.done
+
+    @property
+    def keep_alive(self):
+        return self.headers.get('connection', '').lower() != 'close' and (self.length is not None or self.chunked)
+
+
+class _Connection(asyncio.Protocol if asyncio else object):
+    """Persistent connection sending one request at a time."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.transport = None
+        self.response = None
+        self.future = None
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, method, target, headers, body, future):
+        self.response = _Response(method)
+        self.future = future
+        lines = ['%s %s HTTP/1.1' % (method, target)]
+        lines.extend('%s: %s' % item for item in headers.items())
+        self.transport.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+    def data_received(self, data):
+        if not self.response:
+            return
+        self.response.feed(data)
+        if self.response.done:
+            self._finish()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if self.response and self.response.eof():
+            self._finish()
+        elif self.future and not self.future.done():
+            self.future.set_exception(exc or IOError('Connection closed by the server'))
+        self.pool.lost(self)
+
+    def _finish(self):
+        response, future = self.response, self.future
+        self.response = self.future = None
+        if not response.keep_alive:
+            self.closed = True
+            self.transport.close()
+        if not future.done():
+            future.set_result((response.status, response.headers, response.body))
+        self.pool.release(self)
+
+
+class _Pool(object):
+    """Persistent connections to one host, requests wait for a free one."""
+
+    def __init__(self, loop, host, port, use_ssl, size):
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.ssl = ssl.create_default_context() if use_ssl else None
+        self.size = size
+        self.idle = []
+        self.connecting = 0
+        self.busy = 0
+        self.waiting = []
+
+    def request(self, method, target, headers, body):
+        future = self.loop.create_future()
+        self.waiting.append((method, target, headers, body, future))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        while self.waiting:
+            if self.idle:
+                connection = self.idle.pop()
+                if connection.closed:
+                    continue
+                method, target, headers, body, future = self.waiting.pop(0)
+                if future.cancelled():
+                    self.idle.append(connection)
+                    continue
+                self.busy += 1
+                connection.send(method, target, headers, body, future)
+            else:
+                # connections being opened will take the oldest waiting requests
+                while self.connecting < len(self.waiting) and self.busy + self.connecting < self.size:
+                    self._connect()
+                return
+
+    def _connect(self):
+        self.connecting += 1
+        connecting = asyncio.ensure_future(self.loop.create_connection(
+            lambda: _Connection(self), self.host, self.port, ssl=self.ssl), loop=self.loop)
+
+        def connected(future):
+            self.connecting -= 1
+            if future.exception() is not None:
+                # requests can't be sent anywhere, fail the oldest one
+                if self.waiting:
+                    self.waiting.pop(0)[-1].set_exception(future.exception())
+            else:
+                self.idle.append(future.result()[1])
+            self._dispatch()
+
+        connecting.add_done_callback(connected)
+
+    def release(self, connection):
+        self.busy -= 1
+        if not connection.closed:
+            self.idle.append(connection)
+        self._dispatch()
+
+    def lost(self, connection):
+        if connection in self.idle:
+            self.idle.remove(connection)
+        elif connection.future is not None:
+            self.busy -= 1
+        self._dispatch()
+
+    def close(self):
+        for connection in self.idle:
+            connection.transport.close()
+        self.idle = []
+
+
+class AsyncLaunchpad(object):
+    """OAuth-signed GET, PATCH and POST of the Launchpad REST API over asyncio."""
+
+    def __init__(self, credentials, service_root=SERVICE_ROOTS['production'], version='1.0',
+                 connections=DEFAULT_CONNECTIONS, loop=None):
+        if asyncio is None:
+            raise RuntimeError('The asyncio backend needs Python 3')
+        self.credentials = credentials
+        self.root = '%s%s/' % (SERVICE_ROOTS.get(service_root, service_root), version)
+        self.connections = connections
+        self.loop = loop or asyncio.new_event_loop()
+        self.pools = {}
+
+    @classmethod
+    def from_credentials_file(cls, path, **kwargs):
+        return cls(Credentials.from_file(path), **kwargs)
+
+    def url(self, link):
+        """Absolute URL of the link or the path relative to the service root."""
+        return link if '://' in link else self.root + link.lstrip('/')
+
+    def request(self, method, link, body=b'', content_type=None):
+        """Return a future of (status, headers, body) of the request."""
+        url = urlsplit(self.url(link))
+        use_ssl = url.scheme == 'https'
+        port = url.port or (443 if use_ssl else 80)
+        key = (url.hostname, port, use_ssl)
+        if key not in self.pools:
+            self.pools[key] = _Pool(self.loop, url.hostname, port, use_ssl, self.connections)
+
+        headers = {
+            'Host': url.netloc,
+            'Accept': 'application/json',
+            'Authorization': self.credentials.authorization(),
+            'Content-Length': str(len(body)),
+        }
+        if content_type:
+            headers['Content-Type'] = content_type
+        target = url.path + ('?' + url.query if url.query else '')
+        return self.pools[key].request(method, target, headers, body)
+
+    def _json(self, method, link):
+        def decode(response):
+            status, headers, body = response
+            if status >= 400:
+                raise HTTPError(method, link, status, body.decode('utf-8', 'replace'))
+            if status == 201 and 'location' in headers:
+                return headers['location']
+            return json.loads(body.decode('utf-8')) if body else None
+        return decode
+
+    def get(self, link, **params):
+        """Future of the decoded resource, named operations are passed as `ws.op` params."""
+        if params:
+            link += ('&' if '?' in link else '?') + urlencode(sorted(params.items()), True)
+        return _chain(self.request('GET', link), self._json('GET', link), self.loop)
+
+    def patch(self, link, values):
+        """Future of the updated entry, `values` are its changed fields (`milestone_link` etc)."""
+        body = json.dumps(values).encode('utf-8')
+        return _chain(self.request('PATCH', link, body, 'application/json'), self._json('PATCH', link), self.loop)
+
+    def post(self, link, operation, **params):
+        """Future of the result of the named operation, the link of a created entry for 201."""
+        params['ws.op'] = operation
+        body = urlencode(sorted(params.items()), True).encode('utf-8')
+        return _chain(self.request('POST', link, body, 'application/x-www-form-urlencoded'),
+                      self._json('POST', link), self.loop)
+
+    def run(self, futures):
+        """Wait for the futures, return their results in order."""
+        return self.loop.run_until_complete(asyncio.gather(*list(futures)))
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+        # let transports finish closing
+        self.loop.run_until_complete(asyncio.sleep(0))
@@ -18,9 +18,15 @@ import ConfigParser
 import logging
 import os
 import sys
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 from launchpadlib.launchpad import Launchpad
 
+import metadata
+from connection_pool import ClientPool, DEFAULT_SIZE as DEFAULT_CONNECTIONS
+
 
 # pylint: disable=E1101
 class LpClient(object):
@@ -37,6 +43,10 @@ class LpClient(object):
     LP_API_VERSION = '1.0'  # it also could be 'devel', but it less stable
     RUN_MODE = 'production'  # staging
     DEFAULT_MAXIMUM = -1  # unlimited
+    # defaults of options which may be omitted, converted to the type of the default
+    OPTION_DEFAULTS = {}
+    # persisted metadata cache is trusted for this amount of seconds
+    METADATA_TTL = metadata.DEFAULT_TTL
 
     SCRIPT_NAME = 'lp_client'
     CREDENTIALS_FILE = SCRIPT_NAME + '_credentials.conf'
@@ -52,41 +62,111 @@ class LpClient(object):
         self.debug = debug
         self.bugs_statistics = {}
         self.processed_issues = 0
+        # issues being processed by worker threads, counted against the limit
+        self.reserved_issues = 0
+        self.lock = threading.RLock()
+        self._local = threading.local()
 
         self.config = self._make_config(options_dct)
 
         self._setup_options(options_dct, self.config)
 
+        # clients with persistent connections shared by threads, the client
+        # logged in upfront is the first one, so no thread owns it
         self.lp_client = self.authenticate_client()
+        self.client_pool = ClientPool(self.authenticate_client, self.get_pool_size())
+        if self.lp_client:
+            self.client_pool.add(self.lp_client)
+
+        self.metadata = metadata.shared(getattr(self, 'metadata_file', None) or None, self.METADATA_TTL)
 
     # public methods section
     def process(self):
         """Start migration processing.
 
         Iterate over all passed projects and process each of them if limit is
-        not exceeded.
+        not exceeded. With `concurrency` above 1 projects are processed in
+        parallel threads.
         """
-        for project_name in self.get_projects():
-            if self.is_limit_achived():
-                break
-
-            self.process_project(project_name)
+        self.map_concurrently(self._process_project_in_limit, self.get_projects())
 
+        self.metadata.save()
+        logging.info('Connection pool: %s', self.client_pool.report())
         logging.info('Migration complete!')
         self.report_statistics(self.get_stats())
 
     def get_lp_client(self):
-        """Launchpad API client getter."""
-        return self.lp_client
+        """Launchpad API client getter.
+
+        Inside `pooled_client` blocks the client checked out of the pool is
+        returned. Otherwise each thread gets its own client, as connections
+        of launchpadlib can't be shared between threads.
+        """
+        if getattr(self._local, 'pooled', None):
+            return self._local.pooled[-1]
+        if not hasattr(self._local, 'lp_client'):
+            self._local.lp_client = self.authenticate_client()
+        return self._local.lp_client
+
+    def get_pool_size(self):
+        """Return the amount of persistent connections shared by threads."""
+        return getattr(self, 'connections', 0) or DEFAULT_CONNECTIONS
+
+    @contextmanager
+    def pooled_client(self):
+        """Check out a pooled client, `get_lp_client` returns it within the block.
+
+        Blocks should be short and shouldn't wait for other threads, so
+        clients are never held by threads waiting for a client.
+        """
+        if not hasattr(self._local, 'pooled'):
+            self._local.pooled = []
+        with self.client_pool.client() as client:
+            self._local.pooled.append(client)
+            try:
+                yield client
+            finally:
+                self._local.pooled.pop()
 
     def get_projects(self):
         """Projects to process getter."""
         return self.projects
 
+    def get_concurrency(self):
+        """Return the amount of projects or milestones processed in parallel."""
+        return getattr(self, 'concurrency', 1)
+
+    def map_concurrently(self, func, items):
+        """Call `func` for every item, in parallel threads if concurrency allows.
+
+        Threads use their own Launchpad clients (`get_lp_client`), so objects
+        loaded by the caller shouldn't be used in `func`. The first error is
+        re-raised after all items were processed.
+        """
+        items = list(items)
+        if self.get_concurrency() <= 1 or len(items) <= 1:
+            for item in items:
+                func(item)
+            return
+
+        pool = ThreadPool(min(self.get_concurrency(), len(items)))
+        try:
+            pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
     def get_stats(self):
         """Return statistics about data being processed."""
         return self.bugs_statistics
 
+    def set_stats(self, project_name, milestone_name=None, **values):
+        """Initialize statistics of the project or its milestone, thread-safe."""
+        with self.lock:
+            stats = self.bugs_statistics.setdefault(project_name, {})
+            if milestone_name is not None:
+                stats[milestone_name] = values
+
     def get_milestone_names(self):
         """Return the list of milestone names."""
         return self.milestones
@@ -101,15 +181,35 @@ class LpClient(object):
 
     def increase_proccessed_issues(self):
         """Increase the amount of processed issues and return its value."""
-        self.processed_issues += 1
-        return self.processed_issues
+        with self.lock:
+            self.processed_issues += 1
+            return self.processed_issues
+
+    def reserve_issue(self):
+        """Reserve the issue to be processed, return False if the limit doesn't allow it.
+
+        Issues processed concurrently are reserved before they are handed to
+        a worker, so the limit is never exceeded.
+        """
+        with self.lock:
+            limit = self.get_limit()
+            if limit != -1 and self.processed_issues + self.reserved_issues >= limit:
+                return False
+            self.reserved_issues += 1
+            return True
+
+    def release_issue(self):
+        """Release the reservation of the issue after it was processed or failed."""
+        with self.lock:
+            self.reserved_issues -= 1
 
     def is_limit_achived(self):
         """Return is the total amount of processed issues is over the max."""
-        more_than_limit = self.get_processed_issues() >= self.get_limit()
-        return (
-            more_than_limit and self.get_limit() != -1
-        )
+        with self.lock:
+            more_than_limit = self.get_processed_issues() >= self.get_limit()
+            return (
+                more_than_limit and self.get_limit() != -1
+            )
 
     def is_debug(self):
         """Return is the current run mode is debug or not."""
@@ -141,6 +241,10 @@ class LpClient(object):
         return self.DEFAULT_MAXIMUM
 
     # private methods section, used internally only
+    def _process_project_in_limit(self, project_name):
+        if not self.is_limit_achived():
+            self.process_project(project_name)
+
     def _setup_logger(self, debug=True):
         """Setup format and debug level for logger output."""
         level = logging.DEBUG  # if debug else logging.INFO
@@ -158,10 +262,13 @@ class LpClient(object):
     def _parse_cli_args(self, ap_obj):
         """Parser for ArgumentParser instance object.
 
-        Return a dict of options required for script execution."""
+        Return a dict of options required for script execution and the
+        config file passed, if any."""
         keys_list = self.required_options()[:]
 
-        return {key: getattr(ap_obj, key) for key in keys_list}
+        options_dct = {key: getattr(ap_obj, key) for key in keys_list}
+        options_dct['config_file'] = getattr(ap_obj, 'config_file', None)
+        return options_dct
 
     def _parse_option(self, option):
         """Parse option value as a string or as a list."""
@@ -191,6 +298,8 @@ class LpClient(object):
                 else:
                     if key == 'maximum':
                         setattr(self, key, self._get_default_maximum())
+                    elif key in self.OPTION_DEFAULTS:
+                        setattr(self, key, self.OPTION_DEFAULTS[key])
                     else:
                         logging.error(key.upper() + " wasn't specified.")
                         exit(1)
@@ -203,24 +312,28 @@ class LpClient(object):
                             'Total amount of issues should be a number.'
                         )
                         exit(1)
+                elif key in self.OPTION_DEFAULTS:
+                    try:
+                        setattr(self, key, type(self.OPTION_DEFAULTS[key])(getattr(self, key)))
+                    except ValueError:
+                        logging.error('%s should be a number.', key.upper())
+                        exit(1)
             else:
                 setattr(self, key, options_dct.get(key))
 
     def _make_config(self, options_dct):
         """Get config based on script execution mode."""
         opts = self.required_options()
-        if any((options_dct[key] for key in opts)):
-            # at least one option was set, assume manual run
-            # with config or not
-            if options_dct.get('config_file', None):
-                # missed options would be retrieved from config passed,
-                # not default
-                config = self.config_parser(
-                    options_dct.get('config_file')
-                )['main']
-            else:
-                # assume all required options was set
-                config = {}
+        if options_dct.get('config_file', None):
+            # missed options would be retrieved from config passed,
+            # not default
+            config = self.config_parser(
+                options_dct.get('config_file')
+            )['main']
+        elif any((options_dct[key] for key in opts)):
+            # at least one option was set, assume manual run,
+            # all required options was set
+            config = {}
         else:
             # no options was set, assume automatic run with default config path
             config = self.config_parser()['main']
@@ -248,9 +361,11 @@ class LpClient(object):
 
     @staticmethod
     def bug_milestone_name(bug):
-        """Bug milestone name or empty str if bug has no target milestone."""
-        milestone = bug.milestone
-        return milestone.name if milestone else ''
+        """Bug milestone name or empty str if bug has no target milestone.
+
+        The name is taken from the link, the milestone entry isn't loaded.
+        """
+        return metadata.milestone_name(bug.milestone_link)
 
     @staticmethod
     def parse_string_list(string_list):
@@ -22,6 +22,8 @@
       -d, --dry_run         dry-run mode to run the script without any actions
                             on data
       -e, --execute         mode to run the script with modifications of data
+      -O, --offline         dry-run mode evaluated on the local mirror built by
+                            import_all.py, without Launchpad requests
       -p PROJECTS, --projects PROJECTS
                             project names in which context script would be
                             executed
@@ -40,6 +42,20 @@
                             executed
       -i BUGS_IMPORTANCE, --bugs_importance BUGS_IMPORTANCE
                             bugs importance to be processed
+      -C CONCURRENCY, --concurrency CONCURRENCY
+                            amount of projects and milestones processed
+                            concurrently
+      -N CONNECTIONS, --connections CONNECTIONS
+                            amount of persistent connections shared by threads
+      -P PAGE_SIZE, --page_size PAGE_SIZE
+                            amount of bugs read from Launchpad per request
+      -w WORKERS, --workers WORKERS
+                            amount of bugs changed concurrently
+      -r WRITE_RATE, --write_rate WRITE_RATE
+                            maximum amount of bug changes started per second
+      -M METADATA_FILE, --metadata_file METADATA_FILE
+                            keep projects and milestones in this file for the
+                            next runs
       --version             show program's version number and exit
 
 
@@ -56,11 +72,30 @@
 
     # run with only config provided:
     $ lp_release_migrator.py -e -c ./lp_release_migrator.conf
+
+    # check the options in seconds on the mirrors fuel.db and mos.db:
+    $ lp_release_migrator.py -O -c ./lp_release_migrator.conf -o 7.0 -n 8.0
+
+    # release day: 16 concurrent writers, at most 10 bugs per second
+    $ lp_release_migrator.py -e -c ./lp_release_migrator.conf -w 16 -r 10
+
+    # all projects and milestones searched in parallel
+    $ lp_release_migrator.py -e -c ./lp_release_migrator.conf -C 4 -w 16
 """
 
 import argparse
+import itertools
+import json
+import os
+import sqlite3
+import urllib
 
+import metadata
 from lp_client import LpClient
+import mirror
+from mirror import MirrorUpdater
+from pipeline import prefetch_pages
+from write_executor import WriteExecutor
 
 
 # pylint: disable=E1101
@@ -75,9 +110,28 @@ class LpReleaseMigrator(LpClient):
     BASE_URL = 'https://api.launchpad.net/devel/'
     # https://api.staging.launchpad.net/devel/
 
+    OPTION_DEFAULTS = {
+        'concurrency': 1,
+        'connections': 0,  # enough for all threads
+        'page_size': 300,  # the maximum of Launchpad
+        'workers': 1,
+        'write_rate': 0.0,  # unlimited
+        'metadata_file': '',  # not persisted
+    }
+
     def __init__(self, debug, *options):
         """LpReleaseMigrator constuctor."""
         super(LpReleaseMigrator, self).__init__(debug, *options)
+        # bugs are migrated once, only their `lp_save` steps are retried (`WriteExecutor.call`)
+        self.write_executor = WriteExecutor(self.workers, self.write_rate, retry_jobs=False)
+        # saved bug tasks are written through to the project mirrors
+        self.mirror_updater = MirrorUpdater()
+
+    def get_pool_size(self):
+        """Return the amount of connections, by default one per writer and two per concurrent search."""
+        if self.connections:
+            return self.connections
+        return self.workers + 2 * self.concurrency
 
     @staticmethod
     def required_options():
@@ -88,7 +142,13 @@ class LpReleaseMigrator(LpClient):
             'new_milestone_name',
             'statuses',
             'bugs_importance',
-            'maximum'
+            'maximum',
+            'concurrency',
+            'connections',
+            'page_size',
+            'workers',
+            'write_rate',
+            'metadata_file',
         ]
 
     def get_old_milestone_names(self):
@@ -100,19 +160,28 @@ class LpReleaseMigrator(LpClient):
         return self.new_milestone_name
 
     def get_statuses(self):
-        """Return new milestone name to which the bugs would be migrated."""
-        return self.statuses
+        """Return a list of bug statuses limiting bugs to be migrated."""
+        return self.parse_list(self.statuses)
 
     def get_importance(self):
         """Return a list of bugs priorites limiting bugs to be migrated."""
-        return self.bugs_importance
+        return self.parse_list(self.bugs_importance)
+
+    @staticmethod
+    def parse_list(value):
+        """Return the option as a list, a single config or ENV value is parsed as a string."""
+        return value if isinstance(value, list) else [value]
 
     def process_project(self, project_name):
         """Process release migration for one project."""
         self.logging.debug('Retrieving project %s..', project_name)
 
         try:
-            project = self.get_lp_client().projects[project_name]
+            with self.pooled_client() as lp_client:
+                project = lp_client.projects[project_name]
+                new_milestone = self.metadata.milestone(
+                    lp_client, project.name, self.get_new_milestone_name()
+                )
         except KeyError:
             self.logging.error(
                 "Project %s wasn't found. Skipped..",
@@ -121,22 +190,22 @@ class LpReleaseMigrator(LpClient):
         else:
             if project:
                 self.logging.debug(
-                    'Retrieving active milestone %s..',
-                    self.get_new_milestone_name()
+                    'Active milestone %s: %s',
+                    self.get_new_milestone_name(),
+                    new_milestone.self_link if new_milestone else 'not found'
                 )
+                self.set_stats(project.name)
 
-                new_milestone = project.getMilestone(
-                    name=self.get_new_milestone_name()
-                )
-                self.get_stats()[project.name] = {}
+                def process_milestone(old_milestone_name):
+                    if not self.is_limit_achived():
+                        self.process_milestone_on_project(
+                            project, old_milestone_name, new_milestone
+                        )
 
-                for old_milestone_name in self.get_old_milestone_names():
-                    if self.is_limit_achived():
-                        break
+                self.map_concurrently(process_milestone, self.get_old_milestone_names())
 
-                    self.process_milestone_on_project(
-                        project, old_milestone_name, new_milestone
-                    )
+                # statistics of the project are complete after its writes
+                self.write_executor.join()
 
             else:
                 self.logging.debug(
@@ -148,12 +217,17 @@ class LpReleaseMigrator(LpClient):
                                      project,
                                      old_milestone_name,
                                      new_milestone):
-        """Process selected milestone migration."""
+        """Process selected milestone migration.
+
+        May be called in parallel threads, only the name of the `project` is
+        used and the milestone is loaded with the client of the thread.
+        """
         self.logging.debug(
             'Retrieving closed milestone %s..',
             old_milestone_name
         )
-        old_milestone = project.getMilestone(name=old_milestone_name)
+        with self.pooled_client() as lp_client:
+            old_milestone = self.metadata.milestone(lp_client, project.name, old_milestone_name)
 
         if old_milestone:
             self.logging.debug(
@@ -161,81 +235,138 @@ class LpReleaseMigrator(LpClient):
                 old_milestone.name
             )
 
-            old_bugs = old_milestone.searchTasks(
-                status=self.statuses,
-                importance=self.bugs_importance
-            )
+            pages = prefetch_pages(self.get_page, self.search_tasks_url(old_milestone))
+            first_page = next(pages, None) or {'entries': [], 'total_size': 0}
 
-            bugs_num = len(old_bugs)
+            bugs_num = self.total_size(first_page)
             self.logging.debug('Got %s bugs..', bugs_num)
 
-            self.get_stats()[project.name][old_milestone_name] = {
-                'total': bugs_num,
-                'migrated': 0
-            }
+            self.set_stats(project.name, old_milestone_name, total=bugs_num, migrated=0)
 
+            old_bugs = (entry for page in itertools.chain([first_page], pages) for entry in page['entries'])
             for bug in old_bugs:
-                if self.is_limit_achived():
-                    break
-                self.logging.debug("Bug #%s %s [%s]",
-                                   bug.bug.id,
-                                   bug.bug.title[0:80] + ('' if len(bug.bug.title) < 80 else '...'),
-                                   bug.web_link)
-                if self.is_targeted_for_maintenance(bug):
-                    self.process_mtn_bug(
-                        bug, project.name, old_milestone_name, new_milestone
-                    )
-                else:
-                    self.process_not_mtn_bug(
-                        bug, project.name, old_milestone_name, new_milestone
-                    )
-                self.logging.debug("")
+                if not self.reserve_issue():
+                    # reserved bugs may fail, wait for them before giving up
+                    self.write_executor.join()
+                    if not self.reserve_issue():
+                        break
+                # the title of the task includes the bug title, the bug entry isn't loaded
+                self.logging.debug("%s [%s]",
+                                   bug['title'][0:80] + ('' if len(bug['title']) < 80 else '...'),
+                                   bug['web_link'])
+                self.write_executor.submit(
+                    self.bug_id(bug['bug_link']), self.migrate_bug, bug['self_link'], project.name,
+                    old_milestone_name, new_milestone
+                )
+            pages.close()
         else:
             self.logging.debug(
                 "Closed milestone %s wasn't found. Skipped..",
                 old_milestone_name
             )
 
-    def is_targeted_for_maintenance(self, bug):
-        """Check if the bug targeted to maintenance milestone."""
-        tasks = bug.related_tasks
+    def migrate_bug(self,
+                    bug_link,
+                    project_name,
+                    old_milestone_name,
+                    new_milestone):
+        """Migrate the bug task, called by threads of the write executor.
 
-        return any(
-            '-mu' in self.bug_milestone_name(task) for task in tasks
-        )
+        The bug task is loaded with a client checked out of the pool, it is
+        used for all requests of the bug. The job isn't retried as a whole, so
+        the reservation of the bug is released exactly once.
+        """
+        try:
+            with self.pooled_client() as lp_client:
+                bug = lp_client.load(bug_link)
+                related_milestones = self.related_milestone_names(bug)
+                if self.is_targeted_for_maintenance(related_milestones):
+                    self.process_mtn_bug(
+                        bug, project_name, old_milestone_name, new_milestone, related_milestones
+                    )
+                else:
+                    self.process_not_mtn_bug(
+                        bug, project_name, old_milestone_name, new_milestone, related_milestones
+                    )
+        finally:
+            self.release_issue()
+
+    @staticmethod
+    def bug_id(bug_link):
+        """Id of the bug taken from its link."""
+        return int(bug_link.rsplit('/', 1)[-1])
+
+    def search_tasks_url(self, milestone):
+        """URL of the first page of bug tasks of the milestone to be migrated."""
+        params = [('ws.op', 'searchTasks'), ('ws.size', self.page_size)]
+        params.extend(('status', status) for status in self.get_statuses())
+        params.extend(('importance', importance) for importance in self.get_importance())
+        return '%s?%s' % (milestone.self_link, urllib.urlencode(params))
+
+    def get_page(self, url):
+        """Read the collection page, called by the page prefetching thread."""
+        with self.pooled_client() as lp_client:
+            return json.loads(lp_client._browser.get(url))
+
+    def total_size(self, page):
+        """Size of the collection reported by its first page.
+
+        Launchpad links the size of collections it doesn't count upfront,
+        then it is requested separately.
+        """
+        if 'total_size' in page:
+            return page['total_size']
+        with self.pooled_client() as lp_client:
+            return json.loads(lp_client._browser.get(page['total_size_link']))
+
+    def related_milestone_names(self, bug):
+        """Milestone names of the other tasks of the bug.
+
+        All tasks of the bug are read in one collection request and names are
+        taken from milestone links, no task or milestone entry is loaded.
+        """
+        entries = json.loads(self.get_lp_client()._browser.get(bug.bug_link + '/bug_tasks'))['entries']
+        return [metadata.milestone_name(entry['milestone_link'])
+                for entry in entries if entry['self_link'] != bug.self_link]
+
+    @staticmethod
+    def is_targeted_for_maintenance(related_milestones):
+        """Check if the bug targeted to maintenance milestone."""
+        return any('-mu' in name for name in related_milestones)
 
-    def add_target_to_bug(self, bug, project_name, new_milestone):
+    def add_target_to_bug(self, bug, project_name, new_milestone, related_milestones):
         """Add new target for bug with copied attributes."""
         ms_name = self.get_new_milestone_name()
 
-        tasks = bug.related_tasks
         # check if already targeted
-        if any(self.bug_milestone_name(task) == ms_name for task in tasks):
+        if ms_name in related_milestones:
             return False
 
-        print(ms_name, [self.bug_milestone_name(task) for task in tasks])
+        self.logging.debug("Bug #%s milestones: %s", self.bug_id(bug.bug_link), ', '.join(related_milestones))
         old_status = bug.status
         old_importance = bug.importance
-        old_assignee = bug.assignee
+        # links are copied as they are, the person entry isn't loaded
+        old_assignee = bug.assignee_link
         self.logging.debug("Add milestone %s, status %s, importance %s, assignee %s",
                            new_milestone.name, old_status, old_importance,
-                           old_assignee.name if old_assignee else 'Unassigned')
+                           metadata.person_name(old_assignee) or 'Unassigned')
         if self.is_debug():
             return False
         try:
-            target = bug.bug.addTask(target=new_milestone.series_target)
+            target = bug.bug.addTask(target=new_milestone.series_target_link)
 
-            target.milestone = new_milestone
+            target.milestone = new_milestone.self_link
             target.status = old_status
             target.importance = old_importance
             target.assignee = old_assignee
 
-            target.lp_save()
+            self.write_executor.call(self.bug_id(bug.bug_link), target.lp_save)
+            self.mirror_updater.write_task(project_name, target)
         except Exception as exc:  # pylint: disable=W0703
             self.logging.error(
                 "Can't save target milestone '%s' for bug #%s : %s",
                 self.get_new_milestone_name(),
-                bug.bug.id,
+                self.bug_id(bug.bug_link),
                 exc
             )
             # self.logging.exception(exc)
@@ -245,11 +376,12 @@ class LpReleaseMigrator(LpClient):
 
 
     def get_updates_milestone_for(self, milestone_name, project_name):
-        """Get updates milestone object by milestone name."""
+        """Get updates milestone of the run metadata by milestone name."""
         updates_milestone_name = milestone_name + '-updates'
 
-        project = self.get_lp_client().projects[project_name]
-        milestone = project.getMilestone(name=updates_milestone_name)
+        milestone = self.metadata.milestone(
+            self.get_lp_client(), project_name, updates_milestone_name
+        )
 
         if not milestone:
             self.logging.error(
@@ -266,7 +398,8 @@ class LpReleaseMigrator(LpClient):
                         bug,
                         project_name,
                         old_milestone_name,
-                        new_milestone):
+                        new_milestone,
+                        related_milestones):
         """Process selected bug that is targeted for maintenance.
 
         Target it for new milestone, and retarget it for 'updates' series."""
@@ -278,71 +411,174 @@ class LpReleaseMigrator(LpClient):
         if not updates_milestone:
             return None
 
-        errors = self.add_target_to_bug(bug, project_name, new_milestone)
+        errors = self.add_target_to_bug(bug, project_name, new_milestone, related_milestones)
 
         self.logging.debug("Set milestone %s", updates_milestone.name, )
         if not self.is_debug() and not errors:
-            bug.milestone = updates_milestone
+            bug.milestone = updates_milestone.self_link
 
             try:
-                bug.lp_save()
+                self.write_executor.call(self.bug_id(bug.bug_link), bug.lp_save)
             except Exception as exc:  # pylint: disable=W0703
                 errors = True
                 self.logging.error(
                     "Can't target bug for maintenance '%s' for bug #%s : %s",
                     old_milestone_name + '-updates',
-                    bug.bug.id,
+                    self.bug_id(bug.bug_link),
                     exc
                 )
                 self.logging.exception(exc)
+            else:
+                self.mirror_updater.write_task(project_name, bug)
 
         if not errors:
-            self.get_stats()[project_name][old_milestone_name]['migrated'] += 1
-            self.increase_proccessed_issues()
+            self.increase_migrated(project_name, old_milestone_name)
         else:
-            self.logging.error("Can't reassign the bug #%s.", bug.bug.id)
+            self.logging.error("Can't reassign the bug #%s.", self.bug_id(bug.bug_link))
 
     def process_not_mtn_bug(self,
                             bug,
                             project_name,
                             old_milestone_name,
-                            new_milestone):
+                            new_milestone,
+                            related_milestones):
         """Process selected bug that isn't targeted for maintenance.
 
         Target it for new milestone, and set "Won't fix" for the old one."""
-        errors = self.add_target_to_bug(bug, project_name, new_milestone)
+        errors = self.add_target_to_bug(bug, project_name, new_milestone, related_milestones)
 
         new_status = "Won't Fix"
         self.logging.debug("Update bug #%s status to '%s' for milestone: %s",
-                           bug.bug.id, new_status, old_milestone_name)
+                           self.bug_id(bug.bug_link), new_status, old_milestone_name)
         if not self.is_debug() and not errors:
             bug.status = new_status
             try:
-                bug.lp_save()
+                self.write_executor.call(self.bug_id(bug.bug_link), bug.lp_save)
             except Exception as exc:  # pylint: disable=W0703
                 errors = True
                 self.logging.error(
                     "Can't update bug #%s status to '%s' for milestone: %s",
-                    bug.bug.id,
+                    self.bug_id(bug.bug_link),
                     new_status,
                     old_milestone_name
                 )
                 self.logging.exception(exc)
+            else:
+                self.mirror_updater.write_task(project_name, bug)
 
         if not errors:
-            self.get_stats()[project_name][old_milestone_name]['migrated'] += 1
-            self.increase_proccessed_issues()
+            self.increase_migrated(project_name, old_milestone_name)
         else:
-            self.logging.error("Can't reassign the bug #%s.", bug.bug.id)
+            self.logging.error("Can't reassign the bug #%s.", self.bug_id(bug.bug_link))
+
+    def increase_migrated(self, project_name, milestone_name):
+        """Count the migrated bug, safe to call from worker threads."""
+        with self.lock:
+            self.get_stats()[project_name][milestone_name]['migrated'] += 1
+            self.increase_proccessed_issues()
+
+
+class OfflineReleaseMigrator(LpReleaseMigrator):
+    """Dry-run of the migration evaluated on the local mirrors (`<project>.db`).
+
+    Bugs are selected and checked for maintenance targets with the same
+    rules as on Launchpad and the same statistics are reported, but nothing
+    is requested. The default per-bug import mirrors every task of a bug,
+    so related tasks of other projects count like they do on Launchpad, a
+    mirror imported with `--collections` lacks them. Milestones are checked
+    in the persisted metadata cache, if there is none they are assumed to
+    exist.
+    """
+
+    @classmethod
+    def authenticate_client(cls):
+        """No Launchpad client is needed."""
+        return None
+
+    def process_project(self, project_name):
+        """Evaluate release migration of one project on its mirror."""
+        path = mirror.db_path(project_name)
+        if not os.path.exists(path):
+            self.logging.error(
+                "Project %s has no mirror %s, run import_all.py. Skipped..",
+                project_name,
+                path
+            )
+            return
+
+        conn = sqlite3.connect(path)
+        try:
+            self.set_stats(project_name)
+            for old_milestone_name in self.get_old_milestone_names():
+                if self.is_limit_achived():
+                    break
+                self.process_milestone_on_mirror(conn, project_name, old_milestone_name)
+        finally:
+            conn.close()
+
+    def milestone_exists(self, project_name, milestone_name):
+        project = self.metadata.cached(project_name)
+        return not project or milestone_name in project['milestones']
+
+    def process_milestone_on_mirror(self, conn, project_name, old_milestone_name):
+        """Evaluate selected milestone migration on the mirror."""
+        if not self.milestone_exists(project_name, old_milestone_name):
+            self.logging.debug(
+                "Closed milestone %s wasn't found. Skipped..",
+                old_milestone_name
+            )
+            return
+
+        statuses = self.get_statuses()
+        importances = self.get_importance()
+        tasks = conn.execute(
+            'SELECT bug_id, target FROM bug_tasks WHERE milestone = ? AND (target = ? OR target LIKE ?) '
+            'AND status IN (%s) AND importance IN (%s) ORDER BY bug_id, target' % (
+                ', '.join('?' * len(statuses)), ', '.join('?' * len(importances))),
+            [old_milestone_name, project_name, project_name + '/%'] + statuses + importances
+        ).fetchall()
+        self.logging.debug('Got %s bugs..', len(tasks))
+        self.set_stats(project_name, old_milestone_name, total=len(tasks), migrated=0)
+
+        bug_tasks = {}
+        for bug_id, target, milestone in conn.execute(
+                'SELECT bug_id, target, milestone FROM bug_tasks WHERE bug_id IN '
+                '(SELECT bug_id FROM bug_tasks WHERE milestone = ?)', (old_milestone_name,)):
+            # milestones of other projects are stored with their project
+            bug_tasks.setdefault(bug_id, []).append((target, metadata.milestone_name(milestone)))
+
+        updates_milestone_name = old_milestone_name + '-updates'
+        for bug_id, target in tasks:
+            if self.is_limit_achived():
+                break
+            related_milestones = [name for other, name in bug_tasks[bug_id] if other != target]
+            maintenance = self.is_targeted_for_maintenance(related_milestones)
+            if maintenance and not self.milestone_exists(project_name, updates_milestone_name):
+                self.logging.error(
+                    "Can't find the milestone '%s' on project '%s'.",
+                    updates_milestone_name,
+                    project_name
+                )
+                continue
+
+            self.logging.debug(
+                "Bug #%s [%s]: %s, %s",
+                bug_id,
+                target,
+                'already targeted' if self.get_new_milestone_name() in related_milestones else 'add target',
+                'set milestone %s' % updates_milestone_name if maintenance else "set status Won't Fix"
+            )
+            self.increase_migrated(project_name, old_milestone_name)
 
 
 def comma_list(string):
     return [i.strip() for i in string.split(',')]
 
 
-def main(cli_args, debug):
+def main(cli_args, debug, offline=False):
     """Main script execute method."""
-    lp_client = LpReleaseMigrator(debug, cli_args)
+    migrator_class = OfflineReleaseMigrator if offline else LpReleaseMigrator
+    lp_client = migrator_class(debug, cli_args)
     lp_client.process()
 
 
@@ -367,6 +603,13 @@ if __name__ == '__main__':
         help='mode to run the script with modifications of data'
     )
 
+    argument_parser.add_argument(
+        '-O', '--offline',
+        action='store_true',
+        help='dry-run mode evaluated on the local mirror built by import_all.py, '
+             'without Launchpad requests'
+    )
+
     argument_parser.add_argument(
         '-p', '--projects',
         action='store',
@@ -414,6 +657,47 @@ if __name__ == '__main__':
         help='bugs importance to be processed'
     )
 
+    argument_parser.add_argument(
+        '-C', '--concurrency',
+        action='store',
+        type=int,
+        help='amount of projects and milestones processed concurrently'
+    )
+
+    argument_parser.add_argument(
+        '-N', '--connections',
+        action='store',
+        type=int,
+        help='amount of persistent connections shared by threads'
+    )
+
+    argument_parser.add_argument(
+        '-P', '--page_size',
+        action='store',
+        type=int,
+        help='amount of bugs read from Launchpad per request'
+    )
+
+    argument_parser.add_argument(
+        '-w', '--workers',
+        action='store',
+        type=int,
+        help='amount of bugs changed concurrently'
+    )
+
+    argument_parser.add_argument(
+        '-r', '--write_rate',
+        action='store',
+        type=float,
+        help='maximum amount of bug changes started per second'
+    )
+
+    argument_parser.add_argument(
+        '-M', '--metadata_file',
+        action='store',
+        help='keep projects and milestones in this file for the next runs'
+    )
+
     argument_parser.add_argument(
         '--version',
         action='version',
@@ -422,7 +706,9 @@ if __name__ == '__main__':
 
     arguments = argument_parser.parse_args()
 
-    if arguments.dry_run:
+    if arguments.offline:
+        main(arguments, debug=True, offline=True)
+    elif arguments.dry_run:
         main(arguments, debug=True)
     elif arguments.execute:
         main(arguments, debug=False)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+  The `metadata` module.
+
+  Run-scoped cache of Launchpad metadata: projects, their series and
+  milestones. Everything a tool needs about a project is read once, on its
+  first use, in a few collection pages, afterwards bugs cost no metadata
+  requests. Names of milestones and people are taken from links of bug
+  tasks, which are part of their representation.
+
+  Only plain names and links are kept, so the cache is shared by threads
+  using their own Launchpad clients and may be persisted between runs.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+DEFAULT_TTL = 3600  # seconds a persisted cache is trusted
+
+Milestone = namedtuple('Milestone', ('name', 'self_link', 'series_target_link'))
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def link_name(link):
+    """Return the last part of the entry link, '' for no link."""
+    return link.rstrip('/').rsplit('/', 1)[-1] if link else ''
+
+
+def milestone_name(link):
+    """Name of the milestone of the link, '' for no milestone."""
+    return link_name(link)
+
+
+def person_name(link):
+    """Name of the person of the link, '' for no person."""
+    return link_name(link).lstrip('~')
+
+
+def shared(path=None, ttl=DEFAULT_TTL):
+    """Return the cache of the current run, created by the first call."""
+    global _shared  # pylint: disable=W0603
+    with _shared_lock:
+        if _shared is None:
+            _shared = MetadataCache(path, ttl)
+        return _shared
+
+
+class MetadataCache(object):
+    """Thread-safe cache of project metadata, optionally persisted to `path`."""
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.projects = {}
+        if path and os.path.exists(path):
+            with open(path) as cache_file:
+                projects = json.load(cache_file)
+            # metadata expires since it was read from Launchpad, not since the last save
+            self.projects = dict((name, project) for name, project in projects.items()
+                                 if time.time() - project['loaded'] <= ttl)
+            if self.projects:
+                logging.info('Metadata of %s loaded from %s', ', '.join(sorted(self.projects)), path)
+
+    def project(self, lp, project_name):
+        """Return metadata of the project, read from Launchpad on first use."""
+        with self.lock:
+            if project_name not in self.projects:
+                self.projects[project_name] = self._load_project(lp, project_name)
+            return self.projects[project_name]
+
+    def cached(self, project_name):
+        """Return metadata of the project if it is cached, without requests."""
+        with self.lock:
+            return self.projects.get(project_name)
+
+    def preload(self, lp, project_names):
+        for project_name in project_names:
+            self.project(lp, project_name)
+
+    def series_link(self, lp, project_name, series_name):
+        """Return the link of the project series or None."""
+        return self.project(lp, project_name)['series'].get(series_name)
+
+    def milestone(self, lp, project_name, name):
+        """Return `Milestone` of the project or None."""
+        milestone = self.project(lp, project_name)['milestones'].get(name)
+        return Milestone(**milestone) if milestone else None
+
+    def save(self):
+        """Persist the cache if it has a path."""
+        if not self.path:
+            return
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(self.projects, cache_file, sort_keys=True)
+            os.rename(tmp_path, self.path)
+
+    def _load_project(self, lp, project_name):
+        logging.debug('Loading metadata of project %s..', project_name)
+        project = lp.projects[project_name]
+        series = dict((item.name, item.self_link) for item in project.series)
+        milestones = dict(
+            (item.name, {'name': item.name, 'self_link': item.self_link,
+                         'series_target_link': item.series_target_link})
+            for item in project.all_milestones
+        )
+        return {
+            'name': project.name,
+            'self_link': project.self_link,
+            'focus': link_name(project.development_focus_link),
+            'series': series,
+            'milestones': milestones,
+            'loaded': time.time(),
+        }
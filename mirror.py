@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+  The `mirror` module.
+
+  Storage layer of the local sqlite mirror of Launchpad bug tasks
+  (`<project>.db`). The mirror is filled by `import_all.py` and queried
+  by `work.py`.
+
+  Writes are buffered by `MirrorWriter` and committed in large transactions
+  using executemany upserts on the unique `(bug_id, target)` key, so a full
+  import costs a handful of fsyncs instead of one per row.
+
+  Every import is journaled: ids of committed bugs (or the next page link of
+  every collection) are stored in the same transaction as their rows, so an
+  interrupted import resumes from the last commit instead of starting over.
+
+  Tools changing bug tasks write them through to the mirror with
+  `MirrorUpdater`, so it stays current between imports.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+URI = 'https://api.launchpad.net/devel'
+
+BUG_TASK_COLUMNS = (
+    'project',
+    'bug_id',
+    'target',
+    'milestone',
+    'status',
+    'importance',
+    'assignee',
+)
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_FLUSH_INTERVAL = 5  # seconds
+
+# the layout matches tables created by `dataset`, so older mirrors are upgraded in place
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS bugs (id INTEGER PRIMARY KEY)',
+    'CREATE TABLE IF NOT EXISTS bug_tasks ('
+    ' id INTEGER PRIMARY KEY, project TEXT, bug_id INTEGER, target TEXT,'
+    ' milestone TEXT, status TEXT, importance TEXT, assignee TEXT)',
+    'CREATE TABLE IF NOT EXISTS sync_state ('
+    ' id INTEGER PRIMARY KEY, project TEXT, watermark TEXT, run_started TEXT, run_mode TEXT)',
+    # journal of the current import run
+    'CREATE TABLE IF NOT EXISTS import_journal (bug_id INTEGER PRIMARY KEY)',
+    'CREATE TABLE IF NOT EXISTS import_pages (target TEXT PRIMARY KEY, next_link TEXT)',
+    'CREATE TABLE IF NOT EXISTS import_synced (bug_id INTEGER, target TEXT, PRIMARY KEY (bug_id, target))',
+)
+
+JOURNAL_TABLES = ('import_journal', 'import_pages', 'import_synced')
+
+
+def db_path(project_name):
+    """Path of the mirror database of the project."""
+    return '%s.db' % project_name
+
+
+def cut_prefix(link, prefix):
+    """Return the link without the prefix, None for no link.
+
+    Links which don't start with the prefix (tasks of other projects) are
+    kept as they are.
+    """
+    if not link:
+        return None
+    return link[len(prefix):] if link.startswith(prefix) else link
+
+
+def api_path(link):
+    """Return the path of the API link below the service root and version, None for no link.
+
+    Clients log in with different API versions, `.../1.0/fuel` and
+    `.../devel/fuel` are both `fuel`.
+    """
+    if not link or '://' not in link:
+        return link or None
+    parts = link.split('/', 4)  # scheme, '', host, version, path
+    return parts[4] if len(parts) == 5 else link
+
+
+def entry_to_row(project_name, bug_id, entry):
+    """Convert bug task JSON entry into the `bug_tasks` row.
+
+    Milestones of other projects keep their project, `other/+milestone/name`,
+    people are stored by their name without `~`, like filters name them.
+    """
+    return {
+        'project': project_name,
+        'bug_id': bug_id,
+        'target': api_path(entry['target_link']),
+        'milestone': cut_prefix(api_path(entry['milestone_link']), project_name + '/+milestone/'),
+        'status': entry['status'],
+        'importance': entry['importance'],
+        'assignee': cut_prefix(api_path(entry['assignee_link']), '~'),
+    }
+
+
+def row_to_entry(project_name, row):
+    """Convert the `bug_tasks` row into a bug task JSON entry with link fields.
+
+    Only the fields stored in the mirror are set, `bug_target_name` follows
+    Launchpad: the project name for project tasks, the series name otherwise.
+    """
+    target = row['target']
+    milestone = row['milestone']
+    if milestone and '/+milestone/' not in milestone:
+        milestone = '%s/+milestone/%s' % (project_name, milestone)
+    return {
+        'self_link': '%s/%s/+bug/%s' % (URI, target, row['bug_id']),
+        'bug_link': '%s/bugs/%s' % (URI, row['bug_id']),
+        'target_link': '%s/%s' % (URI, target),
+        'bug_target_name': target if target == project_name else target.split('/', 1)[-1],
+        'milestone_link': '%s/%s' % (URI, milestone) if milestone else None,
+        'assignee_link': '%s/~%s' % (URI, row['assignee']) if row['assignee'] else None,
+        'status': row['status'],
+        'importance': row['importance'],
+    }
+
+
+def _upgrade(conn):
+    """Upgrade mirrors created by older versions of the importer."""
+    if conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+        # assignees were stored as `~name`
+        conn.execute("UPDATE bug_tasks SET assignee = substr(assignee, 2) WHERE assignee LIKE '~%'")
+        conn.execute('PRAGMA user_version = 1')
+
+    columns = [info[1] for info in conn.execute('PRAGMA table_info(sync_state)')]
+    for column in ('run_started', 'run_mode'):
+        if column not in columns:
+            conn.execute('ALTER TABLE sync_state ADD COLUMN %s TEXT' % column)
+
+    # replace the legacy seven-column index with the unique lookup key
+    indexes = conn.execute('PRAGMA index_list(bug_tasks)').fetchall()
+    if any(index[1] == 'ux_bug_tasks_bug_id_target' for index in indexes):
+        return
+
+    for _, name, unique in [index[:3] for index in indexes]:
+        columns = tuple(info[2] for info in conn.execute('PRAGMA index_info(%s)' % name))
+        if not unique and columns == BUG_TASK_COLUMNS:
+            conn.execute('DROP INDEX %s' % name)
+
+    # keep the latest row of duplicates left by the find_one/insert importer
+    conn.execute('DELETE FROM bug_tasks WHERE id NOT IN '
+                 '(SELECT MAX(id) FROM bug_tasks GROUP BY bug_id, target)')
+    conn.execute('CREATE UNIQUE INDEX ux_bug_tasks_bug_id_target ON bug_tasks (bug_id, target)')
+
+
+def connect(path, **kwargs):
+    """Open the mirror database making sure the schema is up to date."""
+    conn = sqlite3.connect(path, **kwargs)
+    # readers (work.py) are not blocked by the importer
+    conn.execute('PRAGMA journal_mode=WAL')
+    with conn:
+        for statement in SCHEMA:
+            conn.execute(statement)
+        _upgrade(conn)
+    return conn
+
+
+class MirrorWriter(object):
+    """Buffered writer of the bug tasks mirror.
+
+    The writer owns its sqlite connection and must be used from a single
+    thread, it is the only writer of the mirror during an import.
+    """
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.conn = connect(path)
+        # created upfront, DDL statements would commit the open transaction
+        self.conn.execute('CREATE TEMP TABLE seen (bug_id INTEGER, target TEXT)')
+        self.conn.execute('CREATE INDEX temp.ix_seen_bug_id ON seen (bug_id)')
+        self.conn.execute('CREATE TEMP TABLE keep (id INTEGER PRIMARY KEY)')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._bugs = []
+        self._rows = []
+        self._pages = {}
+        self._pending = 0
+        self._flushed_at = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        self.conn.close()
+
+    def write_bug(self, bug_id, rows):
+        """Queue the full list of bug tasks of the bug."""
+        self._bugs.append((bug_id, rows))
+        self._pending += len(rows) + 1
+        self._flush_if_needed()
+
+    def write_rows(self, rows, target=None, next_link=None):
+        """Queue bug tasks coming from a collection page.
+
+        Unlike `write_bug` other tasks of the same bugs are left untouched,
+        use `prune` after a full collection import to remove stale tasks.
+        The link of the next page of the `target` collection is journaled
+        with the rows, an empty link marks the collection as done.
+        """
+        self._rows.extend(rows)
+        if target is not None:
+            self._pages[target] = next_link or ''
+        self._pending += len(rows)
+        self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if self._pending >= self.batch_size or time.time() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Commit queued bugs in one transaction."""
+        if not self._bugs and not self._rows and not self._pages:
+            return
+
+        placeholders = ', '.join('?' * len(BUG_TASK_COLUMNS))
+        bug_rows = [row for _, rows in self._bugs for row in rows]
+        seen = [(row['bug_id'], row['target']) for row in bug_rows]
+
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO bugs (id) VALUES (?)',
+                                  [(bug_id,) for bug_id in
+                                   set(bug_id for bug_id, _ in self._bugs) | set(row['bug_id'] for row in self._rows)])
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO bug_tasks (%s) VALUES (%s)' % (', '.join(BUG_TASK_COLUMNS), placeholders),
+                [tuple(row[name] for name in BUG_TASK_COLUMNS) for row in bug_rows + self._rows]
+            )
+            self.conn.executemany('INSERT OR IGNORE INTO import_synced (bug_id, target) VALUES (?, ?)',
+                                  [(row['bug_id'], row['target']) for row in self._rows])
+            self.conn.executemany('INSERT OR REPLACE INTO import_pages (target, next_link) VALUES (?, ?)',
+                                  self._pages.items())
+            self.conn.executemany('INSERT OR IGNORE INTO import_journal (bug_id) VALUES (?)',
+                                  [(bug_id,) for bug_id, _ in self._bugs])
+
+            # bug tasks deleted on Launchpad
+            self.conn.executemany('INSERT INTO seen (bug_id, target) VALUES (?, ?)', seen)
+            self.conn.executemany('INSERT INTO seen (bug_id, target) VALUES (?, NULL)',
+                                  [(bug_id,) for bug_id, rows in self._bugs if not rows])
+            self.conn.execute(
+                'DELETE FROM bug_tasks WHERE bug_id IN (SELECT bug_id FROM seen) AND NOT EXISTS '
+                '(SELECT 1 FROM seen WHERE seen.bug_id = bug_tasks.bug_id AND seen.target IS bug_tasks.target)'
+            )
+            self.conn.execute('DELETE FROM seen')
+
+        self._bugs = []
+        self._rows = []
+        self._pages = {}
+        self._pending = 0
+        self._flushed_at = time.time()
+
+    def prune(self, project_name):
+        """Remove tasks of the project targets not written by `write_rows` in this run."""
+        self.flush()
+        with self.conn:
+            cursor = self.conn.execute(
+                'DELETE FROM bug_tasks WHERE (target = ? OR target LIKE ?) AND NOT EXISTS '
+                '(SELECT 1 FROM import_synced AS s WHERE s.bug_id = bug_tasks.bug_id AND s.target = bug_tasks.target)',
+                (project_name, project_name + '/%')
+            )
+            self.conn.execute('DELETE FROM bugs WHERE id NOT IN (SELECT bug_id FROM bug_tasks)')
+        return cursor.rowcount
+
+    def begin_run(self, project_name, mode, started, restart=False):
+        """Start a new import run or resume the interrupted one.
+
+        Return the start time of the run and whether it is resumed. Runs
+        are resumed only in the same `mode`, unless `restart` is set.
+        """
+        row = self.conn.execute('SELECT run_started, run_mode FROM sync_state WHERE project = ?',
+                                (project_name,)).fetchone()
+        if row and row[0] and row[1] == mode and not restart:
+            return row[0], True
+
+        with self.conn:
+            for table in JOURNAL_TABLES:
+                self.conn.execute('DELETE FROM %s' % table)
+            self._set_state(project_name, run_started=started, run_mode=mode)
+        return started, False
+
+    def journaled_bugs(self):
+        """Return ids of bugs committed by the current run."""
+        return set(row[0] for row in self.conn.execute('SELECT bug_id FROM import_journal'))
+
+    def journaled_pages(self):
+        """Return next page links of collections imported by the current run."""
+        return dict(self.conn.execute('SELECT target, next_link FROM import_pages'))
+
+    def finish_run(self, project_name, watermark):
+        """Store the watermark after all queued bugs are committed and drop the journal."""
+        self.flush()
+        with self.conn:
+            for table in JOURNAL_TABLES:
+                self.conn.execute('DELETE FROM %s' % table)
+            self._set_state(project_name, watermark=watermark, run_started=None, run_mode=None)
+
+    def get_watermark(self, project_name):
+        """Return the watermark of the last successful import of the project."""
+        row = self.conn.execute('SELECT watermark FROM sync_state WHERE project = ?', (project_name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, project_name, **values):
+        names = sorted(values)
+        cursor = self.conn.execute(
+            'UPDATE sync_state SET %s WHERE project = ?' % ', '.join('%s = ?' % name for name in names),
+            [values[name] for name in names] + [project_name]
+        )
+        if not cursor.rowcount:
+            self.conn.execute(
+                'INSERT INTO sync_state (project, %s) VALUES (?, %s)' % (
+                    ', '.join(names), ', '.join('?' * len(names))),
+                [project_name] + [values[name] for name in names]
+            )
+
+    def reconcile(self, bug_ids):
+        """Remove bugs which are not in `bug_ids`, return amount of removed bugs."""
+        self.flush()
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO keep (id) VALUES (?)', [(i,) for i in bug_ids])
+            self.conn.execute('DELETE FROM bug_tasks WHERE bug_id NOT IN (SELECT id FROM keep)')
+            dropped = self.conn.execute('DELETE FROM bugs WHERE id NOT IN (SELECT id FROM keep)').rowcount
+            self.conn.execute('DELETE FROM keep')
+        return dropped
+
+
+class MirrorUpdater(object):
+    """Write-through of bug tasks saved on Launchpad into the project mirrors.
+
+    Safe to share between threads, every task is committed in its own
+    transaction right after it was saved. Projects without a mirror are
+    ignored, the updater never creates one.
+    """
+
+    ENTRY_FIELDS = ('target_link', 'milestone_link', 'status', 'importance', 'assignee_link')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conns = {}
+
+    def _conn(self, project_name):
+        if project_name not in self.conns:
+            path = db_path(project_name)
+            self.conns[project_name] = (connect(path, timeout=30, check_same_thread=False)
+                                        if os.path.exists(path) else None)
+        return self.conns[project_name]
+
+    def write_task(self, project_name, bug_task):
+        """Store the saved bug task, its representation is refreshed by `lp_save`."""
+        entry = dict((name, getattr(bug_task, name)) for name in self.ENTRY_FIELDS)
+        bug_id = int(bug_task.bug_link.rsplit('/', 1)[1])
+        row = entry_to_row(project_name, bug_id, entry)
+        with self.lock:
+            try:
+                conn = self._conn(project_name)
+                if not conn:
+                    return False
+                with conn:
+                    conn.execute('INSERT OR IGNORE INTO bugs (id) VALUES (?)', (bug_id,))
+                    conn.execute('INSERT OR REPLACE INTO bug_tasks (%s) VALUES (%s)' % (
+                        ', '.join(BUG_TASK_COLUMNS), ', '.join('?' * len(BUG_TASK_COLUMNS))),
+                        tuple(row[name] for name in BUG_TASK_COLUMNS))
+            except sqlite3.Error as exc:
+                # the change is on Launchpad already, the next import fixes the mirror
+                logging.warning("Can't update mirror of %s with bug %s: %s", project_name, bug_id, exc)
+                return False
+        return True
+
+    def close(self):
+        with self.lock:
+            for conn in self.conns.values():
+                if conn:
+                    conn.close()
+            self.conns = {}
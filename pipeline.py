@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+  The `pipeline` module.
+
+  Streaming producer/consumer helpers. Items are pulled lazily from the
+  source by a producer thread into a bounded queue, processed by a pool of
+  worker threads and handed back to the caller as soon as they are ready,
+  so paging a Launchpad collection overlaps with fetching and memory stays
+  flat regardless of the collection size.
+
+  `prefetch_pages` reads pages of a collection one ahead of the consumer.
+"""
+
+import sys
+import threading
+import Queue
+
+DEFAULT_QUEUE_SIZE = 500
+
+_DONE = object()
+
+
+class _Failure(object):
+    """Exception raised in a pipeline thread, re-raised in the consumer."""
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+    def reraise(self):
+        raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    # blocked producers shouldn't keep the interpreter alive if the consumer failed
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _produce(items, tasks, results, workers):
+    try:
+        for item in items:
+            tasks.put(item)
+    except Exception:  # pylint: disable=W0703
+        results.put(_Failure(sys.exc_info()))
+    finally:
+        for _ in range(workers):
+            tasks.put(_DONE)
+
+
+def _work(func, tasks, results):
+    try:
+        while True:
+            item = tasks.get()
+            if item is _DONE:
+                break
+            results.put(func(item))
+    except Exception:  # pylint: disable=W0703
+        results.put(_Failure(sys.exc_info()))
+    finally:
+        results.put(_DONE)
+
+
+def stream(items, func, workers, queue_size=DEFAULT_QUEUE_SIZE):
+    """Yield `func(item)` for every item of `items`, in completion order.
+
+    `items` may be any lazy iterable, it is consumed by a producer thread,
+    `func` is called by `workers` threads. The first exception raised by
+    the producer or a worker is re-raised in the caller.
+    """
+    tasks = Queue.Queue(queue_size)
+    results = Queue.Queue(queue_size)
+
+    _start(_produce, items, tasks, results, workers)
+    for _ in range(workers):
+        _start(_work, func, tasks, results)
+
+    running = workers
+    while running:
+        result = results.get()
+        if result is _DONE:
+            running -= 1
+        elif isinstance(result, _Failure):
+            result.reraise()
+        else:
+            yield result
+
+
+def _put(queue, item, stop):
+    """Put the item unless the consumer went away, return whether it was put."""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            continue
+    return False
+
+
+def _fetch_pages(get, url, pages, stop):
+    try:
+        while url and not stop.is_set():
+            page = get(url)
+            url = page.get('next_collection_link')
+            if not _put(pages, page, stop):
+                return
+    except Exception:  # pylint: disable=W0703
+        _put(pages, _Failure(sys.exc_info()), stop)
+    finally:
+        _put(pages, _DONE, stop)
+
+
+def prefetch_pages(get, url):
+    """Yield pages of the collection, the next one is read while the current is processed.
+
+    `get(url)` returns the parsed JSON page and is called by a background
+    thread, so it should use a Launchpad client of that thread. Closing the
+    generator early stops the background thread.
+    """
+    pages = Queue.Queue(1)
+    stop = threading.Event()
+    _start(_fetch_pages, get, url, pages, stop)
+    try:
+        while True:
+            page = pages.get()
+            if page is _DONE:
+                break
+            elif isinstance(page, _Failure):
+                page.reraise()
+            yield page
+    finally:
+        stop.set()
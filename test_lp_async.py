@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+  Tests of the `lp_async` module against a local fake Launchpad server.
+
+  Usage (Python 3):
+    $ python3 -m unittest test_lp_async
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:  # Python 2, the tests are skipped
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+import lp_async
+
+CREDENTIALS = """[1]
+consumer_key = lp_release_migrator
+consumer_secret =
+access_token = token
+access_secret = secret
+"""
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.entries = {}
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """Keep-alive handler of the few resources used by the tests."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b'', headers=None, chunked=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(body), 7):
+                chunk = body[start:start + 7]
+                self.wfile.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def record(self, body=b''):
+        url = urlsplit(self.path)
+        with self.server.lock:
+            self.server.requests.append((self.command, url.path, parse_qs(url.query), self.headers, body))
+        return url
+
+    def do_GET(self):
+        url = self.record()
+        if url.path == '/1.0/missing':
+            self.reply(404, b'Object: missing')
+        elif url.path.startswith('/1.0/bugs/'):
+            bug_id = int(url.path.rsplit('/', 1)[1])
+            body = json.dumps({'id': bug_id, 'title': 'Bug %s' % bug_id}).encode('utf-8')
+            self.reply(200, body, {'Content-Type': 'application/json'}, chunked=bug_id % 2 == 1)
+        else:
+            self.reply(200, json.dumps({'path': url.path, 'query': parse_qs(url.query)}).encode('utf-8'))
+
+    def do_PATCH(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        url = self.record(body)
+        entry = self.server.entries.setdefault(url.path, {})
+        entry.update(json.loads(body.decode('utf-8')))
+        self.reply(209, json.dumps(entry).encode('utf-8'), {'Content-Type': 'application/json'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.record(body)
+        params = parse_qs(body.decode('utf-8'))
+        location = 'http://%s:%s/1.0/%s' % (self.server.server_address + (params['target'][0],))
+        self.reply(201, headers={'Location': location})
+
+
+@unittest.skipIf(lp_async.asyncio is None, 'the asyncio backend needs Python 3')
+class AsyncLaunchpadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.tmp = tempfile.mkdtemp()
+        credentials_file = os.path.join(self.tmp, 'credentials.conf')
+        with open(credentials_file, 'w') as credentials:
+            credentials.write(CREDENTIALS)
+        self.client = lp_async.AsyncLaunchpad.from_credentials_file(
+            credentials_file, service_root='http://127.0.0.1:%s/' % self.server.server_address[1], connections=4)
+
+    def tearDown(self):
+        self.client.close()
+        self.client.loop.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_concurrent_gets_reuse_connections(self):
+        bugs = self.client.run(self.client.get('bugs/%s' % bug_id) for bug_id in range(200))
+        self.assertEqual([bug['id'] for bug in bugs], list(range(200)))
+        self.assertEqual(bugs[7]['title'], 'Bug 7')  # chunked response
+        self.assertLessEqual(self.server.connections, 4)
+
+    def test_requests_are_signed(self):
+        self.client.run([self.client.get('projects')])
+        authorization = self.server.requests[0][3]['Authorization']
+        self.assertTrue(authorization.startswith('OAuth realm="https://api.launchpad.net/"'))
+        self.assertIn('oauth_consumer_key="lp_release_migrator"', authorization)
+        self.assertIn('oauth_token="token"', authorization)
+        self.assertIn('oauth_signature="%26secret"', authorization)
+
+    def test_named_operation_params(self):
+        result, = self.client.run([self.client.get('fuel/+milestone/8.0', **{
+            'ws.op': 'searchTasks', 'status': ['New', 'Triaged']})])
+        self.assertEqual(result['query'], {'ws.op': ['searchTasks'], 'status': ['New', 'Triaged']})
+
+    def test_patch(self):
+        entry, = self.client.run([self.client.patch('fuel/+bug/1', {'status': "Won't Fix"})])
+        self.assertEqual(entry, {'status': "Won't Fix"})
+        method, path, _, headers, body = self.server.requests[0]
+        self.assertEqual((method, path), ('PATCH', '/1.0/fuel/+bug/1'))
+        self.assertEqual(headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(body.decode('utf-8')), {'status': "Won't Fix"})
+
+    def test_post_returns_created_link(self):
+        link, = self.client.run([self.client.post('bugs/1', 'addTask', target='fuel/9.0')])
+        self.assertTrue(link.endswith('/1.0/fuel/9.0'))
+        self.assertEqual(parse_qs(self.server.requests[0][4].decode('utf-8')),
+                         {'ws.op': ['addTask'], 'target': ['fuel/9.0']})
+
+    def test_error_status(self):
+        with self.assertRaises(lp_async.HTTPError) as raised:
+            self.client.run([self.client.get('missing')])
+        self.assertEqual(raised.exception.status, 404)
+        # the connection is kept for the next request
+        self.assertEqual(self.client.run([self.client.get('bugs/2')])[0]['id'], 2)
+        self.assertEqual(self.server.connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
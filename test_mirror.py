@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+  Tests of the `mirror` module.
+
+  Usage:
+    $ python -m unittest test_mirror
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mirror
+
+DEVEL = 'https://api.launchpad.net/devel'
+V1 = 'https://api.launchpad.net/1.0'
+
+
+def entry(root, target='fuel', milestone='7.0', status='New', assignee='bob'):
+    return {
+        'self_link': '%s/%s/+bug/1' % (root, target),
+        'bug_link': '%s/bugs/1' % root,
+        'target_link': '%s/%s' % (root, target),
+        'milestone_link': '%s/fuel/+milestone/%s' % (root, milestone) if milestone else None,
+        'status': status,
+        'importance': 'High',
+        'assignee_link': '%s/~%s' % (root, assignee) if assignee else None,
+    }
+
+
+class BugTask(object):
+    """Saved launchpadlib bug task, as seen by `MirrorUpdater.write_task`."""
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+class EntryToRowTest(unittest.TestCase):
+
+    def test_api_versions_give_the_same_row(self):
+        self.assertEqual(mirror.entry_to_row('fuel', 1, entry(V1)), mirror.entry_to_row('fuel', 1, entry(DEVEL)))
+
+    def test_names(self):
+        row = mirror.entry_to_row('nova', 1, entry(V1, target='nova', milestone='future', assignee='nick'))
+        self.assertEqual((row['target'], row['assignee']), ('nova', 'nick'))
+        self.assertEqual(row['milestone'], 'fuel/+milestone/future')  # milestone of another project
+        row = mirror.entry_to_row('fuel', 1, entry(V1, target='fuel/9.0', milestone='future'))
+        self.assertEqual((row['target'], row['milestone']), ('fuel/9.0', 'future'))
+
+    def test_empty_links(self):
+        row = mirror.entry_to_row('fuel', 1, entry(V1, milestone=None, assignee=None))
+        self.assertEqual((row['milestone'], row['assignee']), (None, None))
+
+    def test_row_to_entry(self):
+        for project_name in ('fuel', 'mos'):
+            row = mirror.entry_to_row(project_name, 1, entry(DEVEL))
+            converted = mirror.row_to_entry(project_name, row)
+            self.assertEqual(mirror.entry_to_row(project_name, 1, converted), row)
+            self.assertEqual(converted['milestone_link'], DEVEL + '/fuel/+milestone/7.0')
+            self.assertEqual(converted['assignee_link'], DEVEL + '/~bob')
+
+
+class MirrorUpdaterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        with mirror.MirrorWriter(mirror.db_path('fuel')) as writer:
+            writer.write_bug(1, [mirror.entry_to_row('fuel', 1, entry(DEVEL))])
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def rows(self):
+        conn = mirror.connect(mirror.db_path('fuel'))
+        try:
+            return conn.execute('SELECT target, milestone, status, assignee FROM bug_tasks').fetchall()
+        finally:
+            conn.close()
+
+    def test_write_through_updates_the_imported_row(self):
+        updater = mirror.MirrorUpdater()
+        saved = entry(V1, milestone='7.0-updates', status="Won't Fix")
+        self.assertTrue(updater.write_task('fuel', BugTask(saved)))
+        updater.close()
+        self.assertEqual(self.rows(), [('fuel', '7.0-updates', "Won't Fix", 'bob')])
+
+    def test_upgrade_strips_assignee_tilde(self):
+        conn = mirror.connect(mirror.db_path('fuel'))
+        with conn:
+            conn.execute("UPDATE bug_tasks SET assignee = '~bob'")
+            conn.execute('PRAGMA user_version = 0')
+        conn.close()
+        self.assertEqual(self.rows()[0][3], 'bob')
+
+    def test_projects_without_mirror_are_ignored(self):
+        updater = mirror.MirrorUpdater()
+        self.assertFalse(updater.write_task('mos', BugTask(entry(V1, target='mos'))))
+        updater.close()
+        self.assertFalse(os.path.exists(mirror.db_path('mos')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,24 @@
 #!/usr/bin/env python
 
+import argparse
+import heapq
 import logging
 from jsonschema import validate
 import yaml
 import json
+import threading
 from launchpadlib.launchpad import Launchpad
 import dataset
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from lazr.restfulclient.errors import PreconditionFailed
+from wadllib.application import Resource as WadlResource
+
+import http_cache
+import metadata
+import mirror
+import write_executor
 
 COPY_FIELDS = [
     'milestone',
@@ -15,6 +27,18 @@ COPY_FIELDS = [
     'assignee',
 ]
 
+# attempts to re-evaluate and save a bug changed concurrently
+SAVE_RETRIES = 3
+
+# bugs read ahead by BTSearch while the current one is processed
+DEFAULT_PREFETCH = 8
+
+# bugs changed concurrently by the plan executor
+DEFAULT_WORKERS = write_executor.DEFAULT_WORKERS
+
+# fields of the source bug task verified before executing planned actions
+VERIFIED_FIELDS = ('status', 'importance', 'milestone_link', 'assignee_link')
+
 logging.addLevelName(logging.DEBUG, "\033[1;36mDEBUG\033[1;0m")
 logging.addLevelName(logging.INFO, "\033[1;32mINFO\033[1;0m")
 logging.addLevelName(logging.WARNING, "\033[1;33mWARNING\033[1;0m")
@@ -28,16 +52,42 @@ logging.basicConfig(
 
 schema = json.load(open('schema.json'))
 
+_local = threading.local()
+
+
+def login():
+    return Launchpad.login_with(
+        application_name='lp_release_migrator',
+        service_root='production',
+        credentials_file='lp_release_migrator/lp_release_migrator_credentials.conf',
+        version='devel'
+    )
+
+
+def thread_lp():
+    """Launchpad client owned by the current thread."""
+    if not hasattr(_local, 'lp'):
+        _local.lp = login()
+    return _local.lp
+
+
+def load_entry(lp, representation):
+    """Bind the JSON representation fetched elsewhere to the client, like `lp.load` without a request."""
+    resource_type = lp._root._wadl.get_resource_type(representation['resource_type_link'])
+    wadl_resource = WadlResource(lp._root._wadl, representation['self_link'], resource_type.tag)
+    return lp._create_bound_resource(lp._root, wadl_resource, representation, 'application/json',
+                                     representation_needs_processing=False)
+
 
 class LPBase(object):
     URI = 'https://api.launchpad.net/devel'
 
     def __init__(self, lp, project_name):
         self.lp = lp
-        self.project = lp.projects[project_name]
         self.project_name = project_name
-        self.focus = self.project.development_focus
-        self.focus_name = self.project_name + "/" + self.project.development_focus.name
+        # project, series and milestones are read once per run
+        self.metadata = metadata.shared()
+        self.focus_name = self.project_name + "/" + self.metadata.project(lp, project_name)['focus']
 
     @property
     def development_focus(self):
@@ -56,226 +106,635 @@ class LPBase(object):
         return value
 
 
+def _intern(value):
+    if value is None:
+        return None
+    try:
+        return intern(str(value))
+    except UnicodeEncodeError:
+        return value
+
+
+class BugTaskRecord(object):
+    """Compact bug task parsed once from its JSON entry.
+
+    Names are interned, so records of a large project share the strings of
+    its few targets, milestones and people and comparing them is mostly an
+    identity check. `index` is the position of the entry in the bug tasks.
+    Names are the ones stored in the mirror (`mirror.entry_to_row`), so
+    filters match the same values on both.
+    """
+
+    __slots__ = ('index', 'self_link', 'target', 'series', 'milestone', 'assignee', 'status', 'importance')
+
+    def __init__(self, index, entry, project_name):
+        self.index = index
+        self.self_link = entry['self_link']
+        row = mirror.entry_to_row(project_name, None, entry)
+        self.target = _intern(row['target'])
+        self.series = self.target.split('/', 1)[1] if '/' in self.target else None
+        self.milestone = _intern(row['milestone'])
+        self.assignee = _intern(row['assignee'])
+        self.status = _intern(row['status'])
+        self.importance = _intern(row['importance'])
+
+    def in_project(self, project_name):
+        return self.target == project_name or self.target.startswith(project_name + '/')
+
+
+class BugSnapshot(object):
+    """Bug tasks of a bug, read once and passed through the whole pipeline.
+
+    Task entries are bound from the snapshot without requests and the entry
+    of the bug itself is loaded only when a task has to be added, so a bug
+    which needs no changes costs the single read of its bug tasks. After
+    this tool changes the bug the snapshot is marked stale and re-read on
+    the next access to `entries`.
+    """
+
+    def __init__(self, lp, bug_id, entries, from_mirror=False, cache=None):
+        self.lp = lp
+        self.id = bug_id
+        self.cache = cache
+        self.stale = False
+        self._bug = None
+        self._tasks = {}
+        self._records = {}
+        self._entries = None
+        self.entries = entries
+        self.from_mirror = from_mirror
+
+    @classmethod
+    def load(cls, lp, bug_id, cache=None):
+        bug = cls(lp, bug_id, None, cache=cache)
+        bug.refresh()
+        return bug
+
+    @property
+    def web_link(self):
+        return "https://bugs.launchpad.net/bugs/%s" % self.id
+
+    @property
+    def entries(self):
+        if self.stale:
+            self.refresh()
+        return self._entries
+
+    @entries.setter
+    def entries(self, entries):
+        self._entries = entries
+        self._tasks = {}
+        self._records = {}
+        self.stale = False
+        self.from_mirror = False
+
+    def records(self, project_name):
+        """Return `BugTaskRecord` of every bug task, parsed once per snapshot."""
+        if self.stale:
+            self.refresh()
+        if project_name not in self._records:
+            self._records[project_name] = [BugTaskRecord(index, entry, project_name)
+                                           for index, entry in enumerate(self._entries)]
+        return self._records[project_name]
+
+    def refresh(self):
+        """Re-read bug tasks from Launchpad."""
+        url = '%s/bugs/%s/bug_tasks' % (LPBase.URI, self.id)
+        if self.cache:
+            body = self.cache.get(self.lp, url)
+        else:
+            body = self.lp._browser.get(url)
+        self.entries = json.loads(body)['entries']
+
+    def invalidate(self):
+        """Mark the snapshot outdated after the bug was changed by this tool."""
+        self.stale = True
+
+    def task(self, link):
+        """Return the Launchpad entry of the bug task, entries built from the mirror are read first."""
+        if self.from_mirror or self.stale:
+            self.refresh()
+        if link not in self._tasks:
+            for live_entry in self._entries:
+                if live_entry['self_link'] == link:
+                    self._tasks[link] = load_entry(self.lp, live_entry)
+                    break
+            else:
+                raise KeyError("Bug task %s doesn't exist anymore" % link)
+        return self._tasks[link]
+
+    @property
+    def lp_bug(self):
+        if self._bug is None:
+            self._bug = self.lp.bugs[self.id]
+        return self._bug
+
+    def __getattr__(self, name):
+        return getattr(self.lp_bug, name)
+
+
+class LazyBugTask(object):
+    """Bug task known by its record in the bug snapshot, bound on demand."""
+
+    def __init__(self, bug, record):
+        self.bug = bug
+        self.record = record
+        self.entry = bug.entries[record.index]
+
+    @property
+    def lp_task(self):
+        return self.bug.task(self.record.self_link)
+
+    def field_value(self, name):
+        """Value of the field for `lp_save`, links are used as they are."""
+        return self.entry.get(name + '_link', self.entry.get(name))
+
+    def __getattr__(self, name):
+        return getattr(self.lp_task, name)
+
+
 class Project(LPBase):
+    # saved bug tasks are written through to the mirror
+    mirror_updater = mirror.MirrorUpdater()
+
     def add_or_update(self, src_bt, target, params=None):
         params = params if isinstance(params, dict) else {}
 
+        bug = src_bt.bug
         dest_bt = None
-        bug_tasks = src_bt.bug.bug_tasks
-        entries = bug_tasks.entries
-        for bt in entries:
-            if bt['target_link'] == self.project_link and target == self.focus_name and not dest_bt:
-                dest_bt = bug_tasks[entries.index(bt)]
-            elif bt['target_link'] == self.target_link(target):
-                dest_bt = bug_tasks[entries.index(bt)]
+        for record in bug.records(self.project_name):
+            if record.target == self.project_name and target == self.focus_name and not dest_bt:
+                dest_bt = bug.task(record.self_link)
+            elif record.target == target:
+                dest_bt = bug.task(record.self_link)
 
         if not dest_bt:
-            dest_bt = src_bt.bug.addTask(target=self.target_link(target))
+            dest_bt = bug.addTask(target=self.target_link(target))
 
+        values = {}
         for field_name in COPY_FIELDS:
             if field_name in params:
-                setattr(dest_bt, field_name, self.conv_to_link(field_name, params[field_name]))
+                values[field_name] = self.conv_to_link(field_name, params[field_name])
             else:
-                setattr(dest_bt, field_name, getattr(src_bt, field_name))
-
-        dest_bt.lp_save()
-
-    def entry_compare(self, entry, params):
+                values[field_name] = src_bt.field_value(field_name)
+
+        try:
+            self.save(dest_bt, values)
+        finally:
+            bug.invalidate()
+        self.mirror_updater.write_task(self.project_name, dest_bt)
+
+    @staticmethod
+    def save(bug_task, values):
+        """Save fields of the bug task.
+
+        `lp_save` sends the ETag of the entry in `If-Match`, so a task changed
+        underneath is rejected with 412 (`PreconditionFailed`) instead of being
+        overwritten, callers evaluate the bug again before the next attempt.
+        """
+        for name, value in values.items():
+            setattr(bug_task, name, value)
+        bug_task.lp_save()
+
+    @staticmethod
+    def entry_compare(record, params):
         for name, value in params.items():
-            if name == 'milestone':
-                if not entry['milestone_link'] == "%s/%s/+milestone/%s" % (self.URI, self.project_name, value):
-                    logging.debug("Failed on milestone_link")
-                    break
-            elif entry[name] != params[name]:
+            if getattr(record, name) != value:
                 logging.debug("Failed on %s", name)
-                break
-        else:
-            return True
-        return False
-
-    def entries_to_dict(self, entries):
-        res = {}
-        for bt in entries:
-            if not bt['self_link'].startswith(self.URI + "/" + self.project_name):
-                continue
-            res[bt['target_link'].lstrip(self.URI)] = bt
-
-        # remove if status is tracked in separate series
-        if self.focus_name in entries:
-            del res[self.project_name]
-
-        return res
+                return False
+        return True
+
+    def entries_to_dict(self, records):
+        return dict((record.target, record) for record in records if record.in_project(self.project_name))
+
+    def plan_bug(self, bug, bt, series, update):
+        """Return (action, destination target to write or None) list for the bug."""
+        src_target = bt.record.target
+        entries_dict = self.entries_to_dict(bug.records(self.project_name))
+
+        # sort series
+        sorted_series = OrderedDict()
+        for key, value in series.items():
+            if key != src_target:
+                sorted_series[key] = value
+        sorted_series[src_target] = series[src_target if src_target in series else self.focus_name]
+
+        # remove project bug task if tracked in series
+        if self.focus_name in sorted_series and self.project_name in sorted_series:
+            del sorted_series[self.project_name]
+
+        actions = []
+        for dest_target, params in sorted_series.items():
+            if dest_target in entries_dict:
+                if update and not self.entry_compare(entries_dict[dest_target], params):
+                    actions.append(("UPDATE series %s bug_task" % dest_target, None))
+            elif dest_target == self.focus_name:
+                if update and not self.entry_compare(entries_dict[self.project_name], params):
+                    actions.append(("UPDATE project %s bug_task" % self.project_name, dest_target))
+            else:
+                actions.append(("ADD series %s" % dest_target, dest_target))
+        return actions
 
-    def apply_rules(self, bug_task_filter, series, update):
+    def apply_rules(self, bug_task_filter, series, update, mirror_freshness=None, prefetch=DEFAULT_PREFETCH):
         if not isinstance(series, dict) or not isinstance(bug_task_filter, dict):
             return None
-
-        targets = {}
-        if update:
-            logging.info("Update if target exists")
-        else:
-            logging.info("No updates if target exists")
-        for name in series.keys():
-            _series = self.project.getSeries(name=name)
-            if _series:
-                targets[name] = _series
-
-        # search for tasks matching criteria
-        tasks = BTSearch(self.lp, self.project_name, **bug_task_filter)
-
-        for bug, bt in tasks:
-            src_target = self.project_name if bt.target == self.project else "%s/%s" % (
-                self.project_name, bt.target.name)
-            logging.info("Apply rules to bug %s, source: %s", bug.web_link, src_target)
-
-            entries = bug.bug_tasks.entries
-            entries_dict = self.entries_to_dict(entries)
-
-            # sort series
-            sorted_series = OrderedDict()
-            for key, value in series.items():
-                if key != src_target:
-                    sorted_series[key] = value
-            sorted_series[src_target] = series[src_target if src_target in series else self.focus_name]
-
-            # remove project bug task if tracked in series
-            if self.focus_name in sorted_series and self.project_name in sorted_series:
-                del sorted_series[self.project_name]
-
-            action_log = []
-            for dest_target, params in sorted_series.items():
-                if dest_target in entries_dict:
-                    if update and not self.entry_compare(entries_dict[dest_target], params):
-                        action_log.append("UPDATE series %s bug_task" % dest_target)
-                elif dest_target == self.focus_name:
-                    if update and not self.entry_compare(entries_dict[self.project_name], params):
-                        self.add_or_update(bt, dest_target, series[dest_target])
-                        action_log.append("UPDATE project %s bug_task" % self.project_name)
+        self.apply_tasks([{'filter': bug_task_filter, 'series': series, 'update_existing': update}],
+                         mirror_freshness, prefetch)
+
+    def plan_writes(self, bug, matches, tasks):
+        """Return coalesced writes of the tasks for the bug and its matching bug task per task.
+
+        Writes are an ordered {destination target: (source bug task, params,
+        action)} dict. All tasks are planned on the same snapshot of the bug.
+        If several tasks write the same target, the later task replaces the
+        earlier write only if it has `update_existing`, as the target exists
+        once the earlier write is done. Otherwise later tasks don't see the
+        changes planned by earlier ones, unlike running them one after another.
+        """
+        writes = OrderedDict()
+        for task, bt in zip(tasks, matches):
+            if not bt:
+                continue
+            logging.info("Apply rules of %s to bug %s, source: %s",
+                         task.get('description', 'task'), bug.web_link, bt.record.target)
+            for action, dest_target in self.plan_bug(bug, bt, task['series'], task['update_existing']):
+                if not dest_target or (dest_target in writes and not task['update_existing']):
+                    continue
+                writes[dest_target] = (bt, task['series'][dest_target], action)
+        return writes
+
+    def bug_writes(self, search, tasks, revalidate):
+        """Yield every bug matching any of the tasks with its coalesced writes, see `plan_writes`."""
+        for bug, matches in search:
+            writes = self.plan_writes(bug, matches, tasks)
+            if revalidate and bug.from_mirror and writes:
+                # decisions made on the mirror are verified against Launchpad before writing,
+                # every task is planned again on the live bug tasks
+                writes = self.plan_writes(bug, search.revalidate_matches(bug), tasks)
+            yield bug, writes
+
+    def apply_tasks(self, tasks, mirror_freshness=None, prefetch=DEFAULT_PREFETCH):
+        """Apply rules of the tasks of the project in a single pass over their candidate bugs."""
+        for task in tasks:
+            logging.info("%s: %s", task.get('description', 'task'),
+                         "update if target exists" if task['update_existing'] else "no updates if target exists")
+            for target in task['series']:
+                if target != self.project_name and not self.metadata.series_link(
+                        self.lp, self.project_name, target.split('/', 1)[-1]):
+                    logging.warning("Series %s doesn't exist", target)
+
+        search = FusedSearch(self.lp, self.project_name, [task['filter'] for task in tasks],
+                             mirror_freshness=mirror_freshness, prefetch=prefetch)
+        for bug, writes in self.bug_writes(search, tasks, revalidate=True):
+            for attempt in range(1, SAVE_RETRIES + 1):
+                try:
+                    for dest_target, (bt, params, _) in writes.items():
+                        self.add_or_update(bt, dest_target, params)
+                except PreconditionFailed:
+                    if attempt == SAVE_RETRIES:
+                        logging.error("Skipping, bug %s keeps being changed concurrently", bug.web_link)
+                        break
+                    # values were planned on outdated bug tasks, plan them again
+                    logging.warning("Bug %s was changed concurrently, re-evaluating", bug.web_link)
+                    writes = self.plan_writes(bug, search.revalidate_matches(bug), tasks)
                 else:
-                    action_log.append("ADD series %s" % dest_target)
-                    self.add_or_update(bt, dest_target, series[dest_target])
-            logging.info("Actions done: %s", ", ".join(action_log) if action_log else "None")
+                    logging.info("Actions done: %s",
+                                 ", ".join(action for _, _, action in writes.values()) if writes else "None")
+                    break
+        logging.info("bug_tasks cache: %s", search.cache.report())
+
+    def plan(self, bug_task_filter, series, update, mirror_freshness=None, prefetch=DEFAULT_PREFETCH):
+        """Yield actions `apply_rules` would do, without changing anything."""
+        return self.plan_tasks([{'filter': bug_task_filter, 'series': series, 'update_existing': update}],
+                               mirror_freshness, prefetch)
+
+    def plan_tasks(self, tasks, mirror_freshness=None, prefetch=DEFAULT_PREFETCH):
+        """Yield actions `apply_tasks` would do, without changing anything.
+
+        Every action is a JSON serializable dict, actions of a bug are yielded
+        together and carry the state of the source bug task they were planned
+        on, so `execute` skips bugs changed since planning.
+        """
+        search = FusedSearch(self.lp, self.project_name, [task['filter'] for task in tasks],
+                             mirror_freshness=mirror_freshness, prefetch=prefetch)
+        for bug, writes in self.bug_writes(search, tasks, revalidate=False):
+            for dest_target, (bt, params, action) in writes.items():
+                yield {
+                    'project': self.project_name,
+                    'bug_id': bug.id,
+                    'source': bt.entry['self_link'],
+                    'expected': dict((name, bt.entry[name]) for name in VERIFIED_FIELDS),
+                    'target': dest_target,
+                    'params': params,
+                    'action': action,
+                }
+        logging.info("bug_tasks cache: %s", search.cache.report())
+
+    def execute(self, actions):
+        """Apply planned actions of one bug, return True if they were applied.
+
+        Actions of several tasks may come from different source bug tasks,
+        every source is verified before anything is written.
+        """
+        bug_id = actions[0]['bug_id']
+        bug = BugSnapshot.load(self.lp, bug_id)
+        records = dict((record.self_link, record) for record in bug.records(self.project_name))
+
+        sources = {}
+        for action in actions:
+            record = records.get(action['source'])
+            if not record or any(bug.entries[record.index][name] != value
+                                 for name, value in action['expected'].items()):
+                logging.warning("Skipping, bug https://bugs.launchpad.net/bugs/%s was changed since planning", bug_id)
+                return False
+            sources[action['source']] = LazyBugTask(bug, record)
+
+        try:
+            for action in actions:
+                self.add_or_update(sources[action['source']], action['target'], action['params'])
+        except PreconditionFailed:
+            logging.warning("Skipping, bug https://bugs.launchpad.net/bugs/%s was changed while executing", bug_id)
+            return False
+        logging.info("Bug https://bugs.launchpad.net/bugs/%s, actions done: %s",
+                     bug_id, ", ".join(action['action'] for action in actions))
+        return True
 
 
 class BTSearch(LPBase):
-    def __init__(self, lp, project_name, **bug_task_filter):
+    """Bug tasks matching the filter, selected on the mirror.
+
+    By default the bug tasks of every candidate are re-read from Launchpad.
+    If the mirror was synced within `mirror_freshness` seconds it is trusted
+    and Launchpad is contacted only to verify bugs which are going to be
+    changed, see `revalidate`.
+
+    Otherwise bug tasks of the next `prefetch` candidates are read in
+    background threads while the current bug is processed.
+    """
+
+    def __init__(self, lp, project_name, mirror_freshness=None, prefetch=DEFAULT_PREFETCH, **bug_task_filter):
         super(BTSearch, self).__init__(lp, project_name)
 
         self.bug_task_filter = bug_task_filter
-
-        db = dataset.connect('sqlite:///%s.db' % project_name)
+        self.cache = http_cache.ResponseCache(http_cache.cache_path(project_name))
+
+        self.db = dataset.connect('sqlite:///%s.db' % project_name)
+        self.trust_mirror = self.mirror_is_fresh(mirror_freshness)
+        if self.trust_mirror:
+            logging.info("Mirror of %s is fresh, evaluating filter locally", project_name)
+        self.res = self.candidate_bugs()
+
+        self.prefetch = 0 if self.trust_mirror else prefetch
+        self.pool = ThreadPool(self.prefetch) if self.prefetch else None
+        self.window = deque()
+
+    def mirror_is_fresh(self, freshness):
+        if freshness is None:
+            return False
+        state = self.db['sync_state'].find_one(project=self.project_name)
+        if not state or not state['watermark']:
+            return False
+        synced = datetime.strptime(state['watermark'][:19], '%Y-%m-%dT%H:%M:%S')
+        return (datetime.utcnow() - synced).total_seconds() <= freshness
+
+    def compile_filter(self, bug_task_filter):
+        """Compile the filter into a parameterized query grouped by bug.
+
+        Exactly one task of a bug should match the filter, except the pair of
+        the project task and the task of the development focus series, which
+        track the same status.
+        """
         where_cause = []
-        for name, cond in bug_task_filter.items():
+        params = {'project': self.project_name, 'focus': self.development_focus}
+        for name, cond in sorted(bug_task_filter.items()):
+            if name not in mirror.BUG_TASK_COLUMNS:
+                raise ValueError("Invalid key %s" % name)
             if isinstance(cond, list):
-                where_cause.append("%s IN (%s)" % (name, ', '.join(["\"%s\"" % str(i) for i in cond])))
+                names = ['%s_%s' % (name, i) for i in range(len(cond))]
+                params.update(zip(names, cond))
+                where_cause.append("%s IN (%s)" % (name, ', '.join(':' + i for i in names)))
             else:
-                where_cause.append(
-                    "%s = %s" % (name, cond if isinstance(cond, int) else '"%s"' % cond.replace('"', '\\"'))
-                )
-
-        # where_cause.append("bug_id = 1568812")
-
-        self.sql = ("SELECT * FROM bug_tasks" + (
-            " WHERE %s" % " AND ".join(where_cause) if where_cause else ""
-        ))
-
-        res = db.query(self.sql)
-        bug_list = {}
-        skip_list = []
-        for row in res:
-            bug_id = row['bug_id']
-
-            # skip if bug is in duplicates
-            if bug_id in skip_list:
-                continue
-
-            if bug_id in bug_list:
-                # check if it is development_focus
-                if row['target'] == project_name and bug_list[bug_id]['target'] == self.development_focus:
-                    # it is project for active focus
-                    pass
-                elif row['target'] == self.development_focus and bug_list[bug_id]['target'] == project_name:
-                    # it is a bug_task with series same as dev_focus
-                    bug_list[bug_id] = row
-                else:
-                    logging.warning("Skipping, bug https://bugs.launchpad.net/bugs/%s "
-                                    "has multiple matching of filter", bug_id)
-                    del bug_list[bug_id]
-                    skip_list.append(bug_id)
+                params[name] = cond
+                where_cause.append("%s = :%s" % (name, name))
+
+        sql = (
+            "SELECT bug_id, "
+            "CASE WHEN COUNT(*) = 1 OR (COUNT(*) = 2 AND "
+            "SUM(target = :project) = 1 AND SUM(target = :focus) = 1) THEN 1 ELSE 0 END AS single_match "
+            "FROM bug_tasks" + (" WHERE %s" % " AND ".join(where_cause) if where_cause else "") +
+            " GROUP BY bug_id ORDER BY bug_id"
+        )
+        return sql, params
+
+    def candidate_bugs(self):
+        """Yield ids of bugs with a single task matching the filter, in order."""
+        sql, params = self.compile_filter(self.bug_task_filter)
+        return self.matching_bugs(self.db.query(sql, **params))
+
+    @staticmethod
+    def matching_bugs(rows):
+        for row in rows:
+            if row['single_match']:
+                yield row['bug_id']
             else:
-                bug_list[bug_id] = row
-        self.res = iter(bug_list.keys())
+                logging.warning("Skipping, bug https://bugs.launchpad.net/bugs/%s "
+                                "has multiple matching of filter", row['bug_id'])
 
     def __iter__(self):
         return self
 
-    def link_to_name(self, name, value):
-        if not value:
-            return value
-        if name == 'target':
-            value = value.lstrip("%s/" % self.URI)
-        elif name == 'milestone':
-            value = value.lstrip("%s/%s/+milestone/" % (self.URI, self.project_name))
-        elif name == 'assignee':
-            value = value.lstrip("%s/~" % self.URI)
-        return value
+    def live_entries(self, bug_id):
+        return json.loads(self.cache.get(self.lp, '%s/bugs/%s/bug_tasks' % (self.URI, bug_id)))['entries']
+
+    def mirror_entries(self, bug_id):
+        rows = self.db.query("SELECT * FROM bug_tasks WHERE bug_id = :bug_id ORDER BY id", bug_id=bug_id)
+        return [mirror.row_to_entry(self.project_name, row) for row in rows]
+
+    def evaluate(self, bug, bug_task_filter=None):
+        """Return bug tasks of the bug matching the filter."""
+        bug_task_filter = self.bug_task_filter if bug_task_filter is None else bug_task_filter
+        results = []
+
+        # making cache
+        cache = {}
+        for record in bug.records(self.project_name):
+            if record.in_project(self.project_name):
+                cache[record.target] = record
+
+        if self.development_focus in cache:
+            # status is tracked in separate series, delete project bug_task
+            del cache[self.project_name]
+
+        for record in cache.values():
+            for key, value in bug_task_filter.items():
+                if key not in BugTaskRecord.__slots__:
+                    logging.error("Invalid key %s", key)
+                    raise StopIteration
+                actual = getattr(record, key)
+                test = "Bug#BT: %s#%s Assert %s == %s: %%s" % (bug.id, record.index, actual, value)
+                if isinstance(value, list) and actual in value or actual == value:
+                    logging.debug(test, "\033[1;32mSuccess\033[1;0m")
+                    continue
+                logging.debug(test, "\033[1;31mFailed\033[1;0m")
+                break
+            else:
+                # everything is matching in entry, saving result
+                results.append(LazyBugTask(bug, record))
+        return results
+
+    def refresh(self, bug):
+        """Re-read bug tasks of the bug from Launchpad."""
+        mirror_entries = bug.entries
+        bug.refresh()
+        if (sorted(mirror.entry_to_row(self.project_name, bug.id, entry) for entry in mirror_entries) !=
+                sorted(mirror.entry_to_row(self.project_name, bug.id, entry) for entry in bug.entries)):
+            logging.warning("Bug %s was changed since it was evaluated, re-evaluating", bug.web_link)
+
+    def revalidate(self, bug, bug_task_filter=None):
+        """Re-evaluate the bug evaluated on the mirror with its live bug tasks.
+
+        Return the matching bug task or None if the bug doesn't match anymore.
+        """
+        self.refresh(bug)
+        results = self.evaluate(bug, bug_task_filter)
+        if len(results) == 1:
+            return results[0]
+        logging.warning("Skipping, bug %s doesn't match the filter anymore", bug.web_link)
+        return None
+
+    def fetch(self, bug_id):
+        """Read bug tasks, called by prefetch threads with their own clients."""
+        lp = thread_lp()
+        entries = json.loads(self.cache.get(lp, '%s/bugs/%s/bug_tasks' % (self.URI, bug_id)))['entries']
+        return bug_id, entries
+
+    def next_bug(self):
+        if self.trust_mirror:
+            bug_id = next(self.res)
+            return BugSnapshot(self.lp, bug_id, self.mirror_entries(bug_id), from_mirror=True, cache=self.cache)
+        if not self.pool:
+            bug_id = next(self.res)
+            return BugSnapshot(self.lp, bug_id, self.live_entries(bug_id), cache=self.cache)
+
+        for bug_id in self.res:
+            self.window.append(self.pool.apply_async(self.fetch, (bug_id,)))
+            if len(self.window) > self.prefetch:
+                break
+        if not self.window:
+            self.pool.close()
+            raise StopIteration
+        bug_id, entries = self.window.popleft().get()
+        return BugSnapshot(self.lp, bug_id, entries, cache=self.cache)
 
     def next(self):
         while True:
-            bug_id = next(self.res)
-            bug_tasks = json.loads(self.lp._browser.get('%s/bugs/%s/bug_tasks' % (self.URI, bug_id)))
-            entries = bug_tasks['entries']
-            results = []
-
-            # making cache
-            cache = {}
-            for bt in entries:
-                if not bt['self_link'].startswith(self.URI + "/" + self.project_name):
-                    continue
-                if bt['bug_target_name'] == self.project_name:
-                    target = bt['bug_target_name']
-                else:
-                    target = self.project_name + "/" + bt['bug_target_name']
-                cache[target] = bt
-
-            if self.development_focus in cache:
-                # status is tracked in separate series, delete project bug_task
-                del cache[self.project_name]
-
-            for target, bt in cache.items():
-                bt_id = entries.index(bt)
-                for key, value in self.bug_task_filter.items():
-                    if key + '_link' in bt:
-                        bt[key] = self.link_to_name(key, bt[key + '_link'])
-                    elif key not in bt:
-                        logging.error("Invalid key %s", key)
-                        raise StopIteration
-                    test = "Bug#BT: %s#%s Assert %s == %s: %%s" % (bug_id, bt_id, bt[key], value)
-                    if isinstance(value, list) and bt[key] in value or bt[key] == value:
-                        logging.debug(test, "\033[1;32mSuccess\033[1;0m")
-                        continue
-                    logging.debug(test, "\033[1;31mFailed\033[1;0m")
-                    break
-                else:
-                    # everything is matching in entry, saving result
-                    bug = self.lp.bugs[bug_id]
-                    results.append((bug, bug.bug_tasks[bt_id]))
+            bug = self.next_bug()
+            bug_id = bug.id
+
+            results = self.evaluate(bug)
             if len(results) == 1:
-                return results[0]
+                return bug, results[0]
             elif len(results) > 1:
                 logging.warning("Skipping, bug https://bugs.launchpad.net/bugs/%s has multiple matching of filter",
                                 bug_id)
 
 
-def main():
-    lp = Launchpad.login_with(
-        application_name='lp_release_migrator',
-        service_root='production',
-        credentials_file='lp_release_migrator/lp_release_migrator_credentials.conf',
-        version='devel'
-    )
+class FusedSearch(BTSearch):
+    """Bugs matching any of several filters of the same project, read once.
+
+    Candidate bugs of all filters are merged into one ordered pass, every bug
+    is evaluated against each filter and yielded with the list of its
+    matching bug task (or None) per filter.
+    """
+
+    def __init__(self, lp, project_name, filters, mirror_freshness=None, prefetch=DEFAULT_PREFETCH):
+        self.filters = filters
+        super(FusedSearch, self).__init__(lp, project_name, mirror_freshness=mirror_freshness, prefetch=prefetch)
+
+    def candidate_bugs(self):
+        streams = []
+        for bug_task_filter in self.filters:
+            sql, params = self.compile_filter(bug_task_filter)
+            streams.append(self.matching_bugs(self.db.query(sql, **params)))
+
+        previous = None
+        for bug_id in heapq.merge(*streams):
+            if bug_id != previous:
+                yield bug_id
+            previous = bug_id
+
+    def matches(self, bug):
+        """Return the matching bug task of the bug (or None) per filter."""
+        matches = []
+        for bug_task_filter in self.filters:
+            results = self.evaluate(bug, bug_task_filter)
+            if len(results) > 1:
+                logging.warning("Skipping, bug %s has multiple matching of filter", bug.web_link)
+            matches.append(results[0] if len(results) == 1 else None)
+        return matches
+
+    def revalidate_matches(self, bug):
+        """Re-evaluate every filter with the live bug tasks of the bug, like `revalidate`."""
+        self.refresh(bug)
+        matches = self.matches(bug)
+        if not any(matches):
+            logging.warning("Skipping, bug %s doesn't match the filters anymore", bug.web_link)
+        return matches
 
-    with open('config.yaml') as f:
+    def next(self):
+        while True:
+            bug = self.next_bug()
+            matches = self.matches(bug)
+            if any(matches):
+                return bug, matches
+
+
+def thread_project(project_name):
+    """Project bound to the Launchpad client of the current thread."""
+    if not hasattr(_local, 'projects'):
+        _local.projects = {}
+    if project_name not in _local.projects:
+        _local.projects[project_name] = Project(thread_lp(), project_name)
+    return _local.projects[project_name]
+
+
+def execute_bug(actions):
+    return thread_project(actions[0]['project']).execute(actions)
+
+
+def read_plan(plan_file):
+    """Yield planned actions grouped by bug."""
+    actions = []
+    for line in plan_file:
+        action = json.loads(line)
+        if actions and (action['project'], action['bug_id']) != (actions[0]['project'], actions[0]['bug_id']):
+            yield actions
+            actions = []
+        actions.append(action)
+    if actions:
+        yield actions
+
+
+def execute_plan(path, workers=DEFAULT_WORKERS, rate=write_executor.DEFAULT_RATE):
+    """Apply the plan written by `work.py --plan`.
+
+    Different bugs are changed concurrently, actions of the same bug (even
+    planned by different tasks) are applied one after another.
+    """
+    jobs = []
+    with open(path) as plan_file:
+        with write_executor.WriteExecutor(workers, rate) as executor:
+            for actions in read_plan(plan_file):
+                jobs.append(executor.submit(actions[0]['bug_id'], execute_bug, actions))
+
+    applied = sum(1 for job in jobs if not job.exc_info and job.value)
+    failed = sum(1 for job in jobs if job.exc_info)
+    logging.info("Plan %s executed: %s bugs changed, %s skipped, %s failed, %s retries", path,
+                 applied, len(jobs) - applied - failed, failed, executor.retried)
+
+
+def load_config(path='config.yaml'):
+    with open(path) as f:
         config = yaml.load(f.read())
     validate(config, schema)
 
@@ -283,11 +742,74 @@ def main():
         for target in task['series'].keys():
             if not target.startswith(task['project']):
                 task['series'][task['project'] + "/" + target] = task['series'].pop(target)
+    return config
 
-    for task in config['tasks']:
-        project = Project(lp, task['project'])
-        logging.info("~~ Project %s, task %s ~~", task['project'], task['description'])
-        project.apply_rules(task['filter'], task['series'], task['update_existing'])
+
+def tasks_by_project(tasks):
+    """Group tasks of the config by project, keeping their order."""
+    grouped = OrderedDict()
+    for task in tasks:
+        grouped.setdefault(task['project'], []).append(task)
+    return grouped
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description="Apply bug tasks rules of config.yaml to Launchpad bugs"
+    )
+    argument_parser.add_argument(
+        '-p', '--plan',
+        action='store',
+        help='write actions into the plan file (JSON lines) instead of applying them'
+    )
+    argument_parser.add_argument(
+        '-x', '--execute',
+        action='store',
+        help='apply actions of the plan file'
+    )
+    argument_parser.add_argument(
+        '-w', '--workers',
+        action='store',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help='amount of bugs changed concurrently by --execute (default: %s)' % DEFAULT_WORKERS
+    )
+    argument_parser.add_argument(
+        '-r', '--rate',
+        action='store',
+        type=float,
+        default=write_executor.DEFAULT_RATE,
+        help='maximum amount of bug writes per second started by --execute (default: unlimited)'
+    )
+    arguments = argument_parser.parse_args()
+
+    if arguments.execute:
+        execute_plan(arguments.execute, arguments.workers, arguments.rate)
+        return
+
+    lp = login()
+    config = load_config()
+    run_metadata = metadata.shared(config.get('metadata_cache'), config.get('metadata_ttl', metadata.DEFAULT_TTL))
+    run_metadata.preload(lp, set(task['project'] for task in config['tasks']))
+
+    if arguments.plan:
+        planned = 0
+        with open(arguments.plan, 'w') as plan_file:
+            for project_name, tasks in tasks_by_project(config['tasks']).items():
+                project = Project(lp, project_name)
+                logging.info("~~ Planning project %s, tasks: %s ~~", project_name,
+                             ", ".join(task['description'] for task in tasks))
+                for action in project.plan_tasks(tasks, config.get('mirror_freshness'),
+                                                 config.get('prefetch', DEFAULT_PREFETCH)):
+                    plan_file.write(json.dumps(action, sort_keys=True) + "\n")
+                    planned += 1
+        logging.info("%s actions planned into %s", planned, arguments.plan)
+    else:
+        for project_name, tasks in tasks_by_project(config['tasks']).items():
+            project = Project(lp, project_name)
+            logging.info("~~ Project %s, tasks: %s ~~", project_name, ", ".join(task['description'] for task in tasks))
+            project.apply_tasks(tasks, config.get('mirror_freshness'), config.get('prefetch', DEFAULT_PREFETCH))
+    run_metadata.save()
 
 
 if __name__ == '__main__':
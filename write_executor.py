@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+  The `write_executor` module.
+
+  Parallel executor of Launchpad writes (`addTask`, `lp_save`).
+
+  Jobs are run by a pool of worker threads, jobs sharing a key (the bug id)
+  are run one after another in submission order while jobs of different
+  bugs run concurrently. Starts of jobs are limited by a token bucket and
+  jobs failed with a server error or a network timeout are retried with
+  exponential backoff. Jobs which aren't idempotent as a whole (`addTask`
+  followed by `lp_save`) are run once and retry their idempotent steps with
+  `WriteExecutor.call` instead.
+"""
+
+import httplib
+import logging
+import random
+import socket
+import sys
+import threading
+import time
+import Queue
+from collections import deque
+
+from lazr.restfulclient.errors import HTTPError
+
+DEFAULT_WORKERS = 8
+DEFAULT_RATE = 0  # jobs per second, unlimited
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0  # seconds, doubled on every retry
+
+_STOP = object()
+
+
+def is_retryable(exc):
+    """Return whether the error is transient: 5xx response or network failure."""
+    if isinstance(exc, HTTPError):
+        return exc.response.status >= 500
+    return isinstance(exc, (socket.error, httplib.HTTPException))
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket, `rate` tokens per second up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Job(object):
+    """Submitted job, `result` waits for its completion."""
+
+    def __init__(self, key, func, args):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def result(self):
+        """Return the value of the job or re-raise its error."""
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class WriteExecutor(object):
+    """Pool of writers with per-key ordering, rate limit and retries.
+
+    `func` of a job is called in a worker thread, launchpadlib objects used
+    by it should be bound to the client of that thread.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, max_pending=None, retry_jobs=True):
+        self.workers = workers
+        self.bucket = TokenBucket(rate) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_jobs = retry_jobs
+
+        self.ready = Queue.Queue()
+        self.lock = threading.Condition()
+        self.waiting = {}  # key -> jobs waiting for the running one
+        self.pending = 0
+        self.max_pending = max_pending or workers * 64
+
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+
+        self.threads = [threading.Thread(target=self._work) for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def submit(self, key, func, *args):
+        """Queue `func(*args)`, blocks while too many jobs are pending."""
+        job = Job(key, func, args)
+        with self.lock:
+            while self.pending >= self.max_pending:
+                self.lock.wait()
+            self.pending += 1
+            if key in self.waiting:
+                self.waiting[key].append(job)
+                return job
+            self.waiting[key] = deque()
+        self.ready.put(job)
+        return job
+
+    def join(self):
+        """Wait for all submitted jobs."""
+        with self.lock:
+            while self.pending:
+                self.lock.wait()
+
+    def shutdown(self):
+        """Wait for all submitted jobs and stop workers."""
+        self.join()
+        for _ in self.threads:
+            self.ready.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self):
+        return {'completed': self.completed, 'failed': self.failed, 'retried': self.retried}
+
+    def call(self, key, func, *args):
+        """Call `func(*args)` in the current thread, retrying transient errors like jobs.
+
+        Meant for idempotent steps of jobs which are not retried as a whole.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except Exception as exc:  # pylint: disable=W0703
+                if attempt == self.retries or not is_retryable(exc):
+                    raise
+                self._backoff(key, exc, attempt)
+
+    def _backoff(self, key, exc, attempt):
+        delay = self.backoff * 2 ** attempt * (1 + random.random())
+        logging.warning("Write %s failed: %s, retrying in %.1f seconds", key, exc, delay)
+        with self.lock:
+            self.retried += 1
+        time.sleep(delay)
+
+    def _run(self, job):
+        retries = self.retries if self.retry_jobs else 0
+        for attempt in range(retries + 1):
+            if self.bucket:
+                self.bucket.acquire()
+            try:
+                job.value = job.func(*job.args)
+                return True
+            except Exception as exc:  # pylint: disable=W0703
+                job.exc_info = sys.exc_info()
+                if attempt == retries or not is_retryable(exc):
+                    return False
+                self._backoff(job.key, exc, attempt)
+                job.exc_info = None
+
+    def _work(self):
+        while True:
+            job = self.ready.get()
+            if job is _STOP:
+                break
+
+            succeeded = self._run(job)
+            if not succeeded:
+                logging.error("Write %s failed: %s", job.key, job.exc_info[1])
+
+            with self.lock:
+                if succeeded:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                waiting = self.waiting[job.key]
+                if waiting:
+                    self.ready.put(waiting.popleft())
+                else:
+                    del self.waiting[job.key]
+                self.pending -= 1
+                self.lock.notify_all()
+            job.done.set()